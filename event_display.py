@@ -7,6 +7,11 @@
 #
 # Usage:
 #   event_display.py [input_geometry] [input_event_data.npz] [event-number]
+#   event_display.py merged.h5 [event-number]
+#
+# h5 files written by preprocessing/CNN_endcaps_npz_to_h5.py are shown as
+# the 40x40 mPMT grid of the CNN input (mPMT tab), with a filter on the
+# label and energy of the events stepped through by Next/Prev.
 #
 # features:
 # buttons: 1) Charge display
@@ -37,14 +42,30 @@ from matplotlib.figure import Figure
 import numpy as np
 import math
 import sys
+import os
 
 import argparse
+import threading
+import collections
+import concurrent.futures
+
+try:
+    # Only needed to display the h5 files of the converter in preprocessing/
+    import h5py
+    sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "preprocessing" ) )
+    from endcaps_h5_io import EventSelection, read_event_data, num_events as h5_num_events
+    from CNN_endcaps_npz_to_h5 import LABEL_NAMES
+except ImportError:
+    h5py = None
+
+H5_EXTENSIONS = ( ".h5", ".hdf5" )
 
 def get_args():
     """
     Command line arguments to the python script
     """
-    parser = argparse.ArgumentParser(description='Display IWCD events from npz files (geometry-file and event-file)')
+    parser = argparse.ArgumentParser(description='Display IWCD events from npz files (geometry-file and event-file),'
+                                     ' or from an h5 file of the converter (h5-file and event number)')
     parser.add_argument('geometry_file', type=str, default=None, nargs='?')
     parser.add_argument('event_file', type=str, default=None, nargs='?')
     parser.add_argument('event', type=int, default=0, nargs='?')
@@ -52,6 +73,161 @@ def get_args():
     return args
 
 
+class EventSource:
+    """
+    Events of an npz event file (as returned by np.load). Each array of the
+    file is decompressed and unpickled once, on first use, and the records
+    of recently used events are kept in an LRU cache of cache_size events.
+    prefetch reads the events around the current one on a background
+    thread, so stepping through the file doesn't wait for the decoding.
+    """
+    HIT_KEYS = ( 'digi_hit_pmt', 'digi_hit_charge', 'digi_hit_time' )
+    TRACK_KEYS = ( 'track_start_position', 'track_stop_position', 'track_pid', 'track_energy' )
+
+    def __init__( self, npzfile, cache_size=64 ):
+        self.npzfile = npzfile
+        self.cache_size = cache_size
+        self.arrays = {}
+        self.events = collections.OrderedDict()
+        # the npz file can't be read by two threads at once
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor( max_workers=1 )
+        self.has_tracks = npzfile is not None and all( key in npzfile.files for key in self.TRACK_KEYS )
+
+    def __getitem__( self, key ):
+        """
+        Returns the decoded array key of the file
+        """
+        with self.lock:
+            if key not in self.arrays:
+                self.arrays[ key ] = self.npzfile[ key ]
+            return self.arrays[ key ]
+
+    def __len__( self ):
+        return len( self[ 'digi_hit_pmt' ] )
+
+    def read_event( self, evno ):
+        """
+        Returns the record of event evno: a dictionary with its HIT_KEYS
+        arrays and its tracks as returned by GetParticleStartStops (empty
+        without track arrays in the file)
+        """
+        record = { key: self[ key ][ evno ] for key in self.HIT_KEYS }
+        if self.has_tracks:
+            record[ 'tracks' ] = GetParticleStartStops( self, evno )
+        else:
+            record[ 'tracks' ] = ( [], [], [], [], [] )
+        return record
+
+    def event( self, evno ):
+        """
+        Returns the record of event evno (see read_event), from the cache
+        if it was read before
+        """
+        with self.lock:
+            if evno in self.events:
+                self.events.move_to_end( evno )
+                return self.events[ evno ]
+        record = self.read_event( evno )
+        with self.lock:
+            self.events[ evno ] = record
+            while len( self.events ) > self.cache_size:
+                self.events.popitem( last=False )
+        return record
+
+    def step( self, evno, step ):
+        """
+        Returns the event step events after evno (before it if step is
+        negative), or None past the end of the file
+        """
+        evno += step
+        return evno if 0 <= evno < len( self ) else None
+
+    def prefetch( self, evno ):
+        """
+        Reads the events before and after evno on the background thread
+        """
+        for step in ( 1, -1 ):
+            neighbour = self.step( evno, step )
+            if neighbour is not None and neighbour not in self.events:
+                self.executor.submit( self.event, neighbour )
+
+
+class H5EventSource( EventSource ):
+    """
+    Events of an h5 file written by preprocessing/CNN_endcaps_npz_to_h5.py
+    (dense, sparse, quantized or sharded), with the interface of
+    EventSource. Opening the file reads nothing, each event is read on its
+    own with read_event_data. Records hold the (40,40,38) image of the
+    event, the first 38 channels with --trigger-mode channels, and its hit
+    channels as digi_hit_pmt (index of the hit PMT in the (40,40,19)
+    charge channels), digi_hit_charge and digi_hit_time.
+    select restricts step, and so the Next and Prev buttons, to the events
+    with a label and in an energy range.
+    """
+    def __init__( self, path, cache_size=64 ):
+        self.h5_file = h5py.File( path, 'r' )
+        self.num_events = h5_num_events( self.h5_file )
+        self.selected = None
+        EventSource.__init__( self, None, cache_size )
+
+    def __getitem__( self, key ):
+        return self.h5_file[ key ]
+
+    def __len__( self ):
+        return self.num_events
+
+    def read_event( self, evno ):
+        with self.lock:
+            image = read_event_data( self.h5_file, evno, evno+1 )[ 0, :, :, :38 ]
+            label = int( self.h5_file[ 'labels' ][ evno ] )
+            energy = float( self.h5_file[ 'energies' ][ evno, 0 ] )
+        hit = image[ :, :, :19 ] != 0
+        return { 'image': image, 'label': label, 'energy': energy,
+                 'digi_hit_pmt': np.flatnonzero( hit ),
+                 'digi_hit_charge': image[ :, :, :19 ][ hit ],
+                 'digi_hit_time': image[ :, :, 19: ][ hit ],
+                 'tracks': ( [], [], [], [], [] ) }
+
+    def select( self, label=None, energy=( None, None ) ):
+        """
+        Keeps the events with label (None for any) and energy in
+        [energy[0], energy[1]) (None for no limit). Uses the event_summary
+        index of the file, or reads the labels and energies of older files.
+        Returns the number of events kept.
+        """
+        if label is None and energy == ( None, None ):
+            self.selected = None
+            return len( self )
+        cuts = {}
+        if label is not None:
+            cuts[ 'label' ] = label
+        if energy != ( None, None ):
+            cuts[ 'energy' ] = energy
+        if 'event_summary' in self.h5_file:
+            self.selected = EventSelection( self.h5_file.filename ).select( **cuts )
+        else:
+            keep = np.ones( len( self ), dtype=bool )
+            if label is not None:
+                keep &= self.h5_file[ 'labels' ][...] == label
+            energies = self.h5_file[ 'energies' ][ :, 0 ]
+            if energy[0] is not None:
+                keep &= energies >= energy[0]
+            if energy[1] is not None:
+                keep &= energies < energy[1]
+            self.selected = np.flatnonzero( keep )
+        return len( self.selected )
+
+    def step( self, evno, step ):
+        if self.selected is None:
+            return EventSource.step( self, evno, step )
+        if step > 0:
+            i = np.searchsorted( self.selected, evno, side='right' ) + step - 1
+        else:
+            i = np.searchsorted( self.selected, evno, side='left' ) + step
+        return int( self.selected[ i ] ) if 0 <= i < len( self.selected ) else None
+
+
 class EventDisplayWindow( tk.Tk ):
     """
     Main tkinter window to select among the different frames.
@@ -71,22 +247,37 @@ class EventDisplayWindow( tk.Tk ):
 
         self.windows = {}
 
-        for win in ( Display3D, ChargeDisplay, TimeDisplay, QTDisplay ):
+        # the frames only make their plots when they are first shown,
+        # h5 files have no tube numbers for the geometry views
+        if isinstance( datafile, H5EventSource ):
+            frames = ( MPMTDisplay, QTDisplay )
+        else:
+            frames = ( Display3D, ChargeDisplay, TimeDisplay, QTDisplay )
+        for win in frames:
             window = win( self.main_window, self )
             self.windows[ win ] = window
             window.grid( row=0, column=0, sticky="nsew"  )
 
-        self.show_window( Display3D )
+        self.show_window( frames[0] )
 
 
     def show_window( self, win ):
         """
-        Selects which frame to display on top
+        Selects which frame to display on top, drawing its plot if it is
+        not drawn yet or shows an older event
         """
         window = self.windows[ win ]
-        window.update_plot()
+        window.show()
         window.tkraise()
 
+    def event_changed( self ):
+        """
+        Marks the plots of all frames out of date after the event changed,
+        they are redrawn with the default zrange when they are shown
+        """
+        for window in self.windows.values():
+            window.set_zrange( [-1.,-1.] )
+
     def quit( self ):
         """
         Quit program. Couldn't get it to cleanup properly, so just did kludge sys.exit()
@@ -111,14 +302,9 @@ def EvDispNavigation( self_frame, main_frame, zrange ):
     global num_events
     frm = tk.Frame( self_frame )
     # buttons to change which plot
-    btn_3ddisp = ttk.Button( frm, text = "3D", command = lambda: main_frame.show_window( Display3D ) )
-    btn_qdisp = ttk.Button( frm, text = "Q", command = lambda: main_frame.show_window( ChargeDisplay ) )
-    btn_tdisp = ttk.Button( frm, text = "T", command = lambda: main_frame.show_window( TimeDisplay ) )
-    btn_qtdisp = ttk.Button( frm, text = "QT", command = lambda: main_frame.show_window( QTDisplay ) )
-    btn_3ddisp.pack(side=tk.LEFT)
-    btn_qdisp.pack(side=tk.LEFT)
-    btn_tdisp.pack(side=tk.LEFT)
-    btn_qtdisp.pack(side=tk.LEFT)
+    for win in main_frame.windows:
+        btn_disp = ttk.Button( frm, text = win.button_text, command = lambda win=win: main_frame.show_window( win ) )
+        btn_disp.pack(side=tk.LEFT)
 
     # current event displayed
     lbl_evno = ttk.Label( frm, text="Event: " )
@@ -128,8 +314,12 @@ def EvDispNavigation( self_frame, main_frame, zrange ):
     entry_evno.pack(side=tk.LEFT)
     lbl_numev = ttk.Label( frm, text=" / "+str(num_events) )
     lbl_numev.pack(side=tk.LEFT)
+    btn_goto = ttk.Button( frm, text = "Go", command = lambda: GoToEvent( self_frame, entry_evno ) )
+    btn_goto.pack(side=tk.LEFT)
     
-    # next event button
+    # previous and next event buttons
+    btn_prevev = ttk.Button( frm, text = "Prev Event", command = lambda: GetPrevEvent( self_frame, entry_evno ) )
+    btn_prevev.pack(side=tk.LEFT)
     btn_nextev = ttk.Button( frm, text = "Next Event", command = lambda: GetNextEvent( self_frame, entry_evno ) )
     btn_nextev.pack(side=tk.LEFT)
 
@@ -153,31 +343,115 @@ def EvDispNavigation( self_frame, main_frame, zrange ):
     # quit button
     btn_quit = ttk.Button( frm, text = "Quit", command = lambda: main_frame.quit() )
     btn_quit.pack(side=tk.LEFT)
+
+    # kept to show the current event and zrange when the plot is updated
+    frm.entry_evno = entry_evno
+    frm.lbl_numev = lbl_numev
+    frm.entry_zmin = entry_zmin
+    frm.entry_zmax = entry_zmax
     
     return frm
 
-        
+def EvDispFilter( self_frame ):
+    """
+    Function to return a frame with the label and energy filter of the
+    events of an h5 file, applied to the Next and Prev buttons.
+    """
+    frm = tk.Frame( self_frame )
+    lbl_label = ttk.Label( frm, text="Label: " )
+    lbl_label.pack(side=tk.LEFT)
+    combo_label = ttk.Combobox( frm, values=( "any", )+LABEL_NAMES, width=10, state="readonly" )
+    combo_label.current( 0 )
+    combo_label.pack(side=tk.LEFT)
+
+    lbl_emin = ttk.Label( frm, text="Energy min: " )
+    lbl_emin.pack(side=tk.LEFT)
+    entry_emin = ttk.Entry( frm, width=10 )
+    entry_emin.pack(side=tk.LEFT)
+    lbl_emax = ttk.Label( frm, text="max (MeV): " )
+    lbl_emax.pack(side=tk.LEFT)
+    entry_emax = ttk.Entry( frm, width=10 )
+    entry_emax.pack(side=tk.LEFT)
+
+    lbl_selected = ttk.Label( frm, text="" )
+    btn_filter = ttk.Button( frm, text = "Apply filter", command = lambda: ApplyFilter( combo_label, entry_emin, entry_emax, lbl_selected ) )
+    btn_filter.pack(side=tk.LEFT)
+    lbl_selected.pack(side=tk.LEFT)
+    return frm
 
-class ChargeDisplay( tk.Frame ):
+def ApplyFilter( combo_label, entry_emin, entry_emax, lbl_selected ):
     """
-    Frame to hold the charge event display.
+    Read the label and energy range of the filter frame, and keep only those
+    events for the Next and Prev buttons. Empty energies have no limit.
+    """
+    label = combo_label.current() - 2 if combo_label.current() > 0 else None
+    energy = tuple( float( entry.get() ) if entry.get().strip() else None
+                    for entry in ( entry_emin, entry_emax ) )
+    num_selected = datafile.select( label, energy )
+    print("Filter label=", label, " energy=", energy, ": ", num_selected, " events")
+    lbl_selected.config( text=" "+str(num_selected)+" events" )
+
+def SetNavigation( frm, zrange ):
+    """
+    Shows the current event number and zrange in the navigation frame frm
+    made by EvDispNavigation.
+    """
+    for entry, value in ( ( frm.entry_evno, event_number ),
+                          ( frm.entry_zmin, zrange[0] ),
+                          ( frm.entry_zmax, zrange[1] ) ):
+        entry.delete( 0, tk.END )
+        entry.insert( 0, str( value ) )
+    frm.lbl_numev.config( text=" / "+str(num_events) )
+
+        
+class LazyDisplay( tk.Frame ):
+    """
+    Base of the display frames. The plot is made by make_plot when the frame
+    is first shown, and later redrawn by update_plot only if the event or
+    zrange changed since it was drawn.
     """
-    global event_number
     def __init__( self, parent, main_win ):
         tk.Frame.__init__( self, parent )
         self.main_window = main_win
-        self.make_plot()
+        self.made = False
+        self.dirty = True
+        self.zrange = [-1.,-1.]
+
+    def set_zrange( self, zrange ):
+        """
+        Sets the zrange of the plot and marks it out of date
+        """
+        self.zrange = zrange
+        self.dirty = True
+
+    def show( self ):
+        """
+        Makes or redraws the plot if it is out of date
+        """
+        if not self.made:
+            self.make_plot( self.zrange )
+            self.made = True
+        elif self.dirty:
+            self.update_plot( self.zrange )
+        self.dirty = False
+
+
+class ChargeDisplay( LazyDisplay ):
+    """
+    Frame to hold the charge event display.
+    """
+    button_text = "Q"
+    global event_number
 
     def update_plot(self, zrange=[-1.,-1.] ):
         """
-        update_plot deletes the existing button frame, toolbar, and plot, 
-        and builds a fresh plot by calling make_plot
+        update_plot puts the current event in the existing plot and redraws it
         """
-        plt.close( self.fig )
-        self.frm_plot.destroy()
-        self.frm_buttons.destroy()
-        self.toolbar.destroy()
-        self.make_plot(zrange)
+        SetNavigation( self.frm_buttons, zrange )
+        UpdateEventDisplay( self.fig, digitubes, digicharges, "Charges for event "+str(event_number), zrange )
+        # forget the zoom history of the previous event
+        self.toolbar.update()
+        self.canvas.draw_idle()
         
     def make_plot(self, zrange=[-1.,-1.] ):
         """
@@ -188,37 +462,33 @@ class ChargeDisplay( tk.Frame ):
         
         self.frm_plot = tk.Frame( self )        
         self.fig = EventDisplay( digitubes, digicharges, "Charges for event "+str(event_number), zrange )
-        canvas = FigureCanvasTkAgg( self.fig, self.frm_plot )
-        canvas.draw()
-        canvas.get_tk_widget().pack( side=tk.BOTTOM, fill=tk.BOTH, expand = True )
+        self.canvas = FigureCanvasTkAgg( self.fig, self.frm_plot )
+        self.canvas.draw()
+        self.canvas.get_tk_widget().pack( side=tk.BOTTOM, fill=tk.BOTH, expand = True )
 
-        self.toolbar = NavigationToolbar2Tk( canvas, self )
+        self.toolbar = NavigationToolbar2Tk( self.canvas, self )
         self.toolbar.update()
-        canvas._tkcanvas.pack( side=tk.TOP, fill=tk.BOTH, expand=True )
+        self.canvas._tkcanvas.pack( side=tk.TOP, fill=tk.BOTH, expand=True )
         self.frm_plot.pack()
         
         
     
-class TimeDisplay( tk.Frame ):
+class TimeDisplay( LazyDisplay ):
     """
     Frame to hold the time event display.
     """
+    button_text = "T"
     global event_number
-    def __init__( self, parent, main_win ):
-        tk.Frame.__init__( self, parent )
-        self.main_window = main_win
-        self.make_plot()
 
     def update_plot(self, zrange=[-1.,-1.] ):
         """
-        update_plot deletes the existing button frame, toolbar, and plot, 
-        and builds a fresh plot by calling make_plot
+        update_plot puts the current event in the existing plot and redraws it
         """
-        plt.close( self.fig )
-        self.frm_plot.destroy()
-        self.frm_buttons.destroy()
-        self.toolbar.destroy()
-        self.make_plot(zrange)
+        SetNavigation( self.frm_buttons, zrange )
+        UpdateEventDisplay( self.fig, digitubes, digitimes, "Times for event "+str(event_number), zrange )
+        # forget the zoom history of the previous event
+        self.toolbar.update()
+        self.canvas.draw_idle()
 
     def make_plot(self,zrange=[-1.,-1.] ):
         """
@@ -229,36 +499,32 @@ class TimeDisplay( tk.Frame ):
 
         self.frm_plot = tk.Frame( self )
         self.fig = EventDisplay( digitubes, digitimes, "Times for event "+str(event_number), zrange )
-        canvas = FigureCanvasTkAgg( self.fig, self.frm_plot )
-        canvas.draw()
-        canvas.get_tk_widget().pack( side = tk.BOTTOM, fill=tk.BOTH, expand = True )
+        self.canvas = FigureCanvasTkAgg( self.fig, self.frm_plot )
+        self.canvas.draw()
+        self.canvas.get_tk_widget().pack( side = tk.BOTTOM, fill=tk.BOTH, expand = True )
 
-        self.toolbar = NavigationToolbar2Tk( canvas, self )
+        self.toolbar = NavigationToolbar2Tk( self.canvas, self )
         self.toolbar.update()
-        canvas._tkcanvas.pack( side=tk.TOP, fill=tk.BOTH, expand=True )
+        self.canvas._tkcanvas.pack( side=tk.TOP, fill=tk.BOTH, expand=True )
         self.frm_plot.pack()
 
             
-class QTDisplay( tk.Frame ):
+class QTDisplay( LazyDisplay ):
     """
     Frame to hold the charge versus time event display.
     """
+    button_text = "QT"
     global event_number
-    def __init__( self, parent, main_win ):
-        tk.Frame.__init__( self, parent )
-        self.main_window = main_win
-        self.make_plot()
         
     def update_plot(self, zrange=[-1.,-1.]):
         """
-        update_plot deletes the existing button frame, toolbar, and plot, 
-        and builds a fresh plot by calling make_plot
+        update_plot puts the current event in the existing plot and redraws it
         """
-        plt.close( self.fig )
-        self.frm_plot.destroy()
-        self.frm_buttons.destroy()
-        self.toolbar.destroy()
-        self.make_plot(zrange)
+        SetNavigation( self.frm_buttons, zrange )
+        UpdateChargeTimeHist( self.fig, digitimes, digicharges, "Q vs T for event "+str(event_number) )
+        # forget the zoom history of the previous event
+        self.toolbar.update()
+        self.canvas.draw_idle()
 
     def make_plot(self, zrange=[-1.,-1.]):
         """
@@ -267,37 +533,72 @@ class QTDisplay( tk.Frame ):
         self.frm_buttons = EvDispNavigation( self, self.main_window, zrange )
         self.frm_buttons.pack()
         
+        if isinstance( datafile, H5EventSource ):
+            EvDispFilter( self ).pack()
+
         self.frm_plot = tk.Frame( self )
         self.fig = ChargeTimeHist( digitimes, digicharges, "Q vs T for event "+str(event_number) )
-        canvas = FigureCanvasTkAgg( self.fig, self.frm_plot )
-        canvas.draw()
-        canvas.get_tk_widget().pack( side = tk.TOP, fill=tk.BOTH, expand = True )
+        self.canvas = FigureCanvasTkAgg( self.fig, self.frm_plot )
+        self.canvas.draw()
+        self.canvas.get_tk_widget().pack( side = tk.TOP, fill=tk.BOTH, expand = True )
 
-        self.toolbar = NavigationToolbar2Tk( canvas, self )
+        self.toolbar = NavigationToolbar2Tk( self.canvas, self )
         self.toolbar.update()
-        canvas._tkcanvas.pack( side=tk.TOP, fill=tk.BOTH, expand=True )
+        self.canvas._tkcanvas.pack( side=tk.TOP, fill=tk.BOTH, expand=True )
         self.frm_plot.pack()
         
-class Display3D( tk.Frame ):
+class MPMTDisplay( LazyDisplay ):
+    """
+    Frame to hold the mPMT grid display of the events of an h5 file.
+    """
+    button_text = "mPMT"
+    global event_number
+
+    def update_plot(self, zrange=[-1.,-1.] ):
+        """
+        update_plot puts the current event in the existing plot and redraws it
+        """
+        SetNavigation( self.frm_buttons, zrange )
+        UpdateMPMTDisplay( self.fig, datafile.event( event_number ), MPMTTitle( event_number ), zrange )
+        # forget the zoom history of the previous event
+        self.toolbar.update()
+        self.canvas.draw_idle()
+
+    def make_plot(self, zrange=[-1.,-1.] ):
+        """
+        makes the button and filter frames, and makes the charge and time grids
+        """
+        self.frm_buttons = EvDispNavigation( self, self.main_window, zrange )
+        self.frm_buttons.pack()
+        EvDispFilter( self ).pack()
+
+        self.frm_plot = tk.Frame( self )
+        self.fig = MPMTDisplayFigure( datafile.event( event_number ), MPMTTitle( event_number ), zrange )
+        self.canvas = FigureCanvasTkAgg( self.fig, self.frm_plot )
+        self.canvas.draw()
+        self.canvas.get_tk_widget().pack( side=tk.BOTTOM, fill=tk.BOTH, expand = True )
+
+        self.toolbar = NavigationToolbar2Tk( self.canvas, self )
+        self.toolbar.update()
+        self.canvas._tkcanvas.pack( side=tk.TOP, fill=tk.BOTH, expand=True )
+        self.frm_plot.pack()
+
+class Display3D( LazyDisplay ):
     """
     Frame to hold the 3D event display.
     """
+    button_text = "3D"
     global event_number
-    def __init__( self, parent, main_win ):
-        tk.Frame.__init__( self, parent )
-        self.main_window = main_win
-        self.make_plot()
 
     def update_plot(self, zrange=[-1.,-1.] ):
         """
-        update_plot deletes the existing button frame, toolbar, and plot, 
-        and builds a fresh plot by calling make_plot
+        update_plot puts the current event in the existing plot and redraws it
         """
-        plt.close( self.fig )
-        self.frm_plot.destroy()
-        self.frm_buttons.destroy()
-        self.toolbar.destroy()
-        self.make_plot(zrange)
+        SetNavigation( self.frm_buttons, zrange )
+        UpdateEventDisplay3D( self.fig, geofile, datafile, event_number, zrange )
+        # forget the zoom history of the previous event
+        self.toolbar.update()
+        self.canvas.draw_idle()
 
     def make_plot(self,zrange=[-1.,-1.] ):
         """
@@ -311,14 +612,14 @@ class Display3D( tk.Frame ):
         lbl_notes.pack(side=tk.TOP)
         
         self.fig = plt.figure(figsize=[12,12])
-        canvas = FigureCanvasTkAgg( self.fig, self.frm_plot )
-        canvas.draw()
+        self.canvas = FigureCanvasTkAgg( self.fig, self.frm_plot )
         EventDisplay3D( self.fig, geofile, datafile, event_number, zrange )
-        canvas.get_tk_widget().pack( side = tk.BOTTOM, fill=tk.BOTH, expand = True )
+        self.canvas.draw()
+        self.canvas.get_tk_widget().pack( side = tk.BOTTOM, fill=tk.BOTH, expand = True )
 
-        self.toolbar = NavigationToolbar2Tk( canvas, self )
+        self.toolbar = NavigationToolbar2Tk( self.canvas, self )
         self.toolbar.update()
-        canvas._tkcanvas.pack( side=tk.TOP, fill=tk.BOTH, expand=True )
+        self.canvas._tkcanvas.pack( side=tk.TOP, fill=tk.BOTH, expand=True )
         self.frm_plot.pack()
 
 
@@ -355,6 +656,57 @@ def PMT_to_flat_cylinder_map_positive( tubes, tube_xyz ):
             mapping[ int( tube-1 ) ] = [ int(round(xflat)), int(round(yflat)) ]
     return mapping
 
+# Size of the flat cylinder image in pixels (1 cm each)
+FLAT_IMAGE_SHAPE = ( 2506, 2317 )
+
+def PMT_flat_stencils( mapping, shape=FLAT_IMAGE_SHAPE ):
+    """
+    Returns an array with the flat indices into an image of shape of the
+    pixels covered by each tube: a 7x7 square without its corners around
+    the tube's (x,y) in mapping (from PMT_to_flat_cylinder_map_positive).
+    Row i holds the pixels of tube i, tubes missing from mapping have none
+    (index -1 in every column).
+    """
+    dx, dy = np.mgrid[ -3:4, -3:4 ]
+    keep = ~( (abs(dx)==3) & (abs(dy)==3) )
+    dx, dy = dx[keep], dy[keep]
+
+    tube_numbers = np.fromiter( mapping.keys(), dtype=np.int64 )
+    xy = np.array( list( mapping.values() ), dtype=np.int64 ).reshape( -1, 2 )
+    stencils = np.full( ( tube_numbers.max()+1, len(dx) ), -1, dtype=np.int64 )
+    # negative indices wrap around, as they did when painting pixel by pixel
+    stencils[ tube_numbers ] = np.ravel_multi_index( ( xy[:,1,None]+dx, xy[:,0,None]+dy ),
+                                                     shape, mode='wrap' )
+    return stencils
+
+# Flat cylinder image reused by PaintFlatImage, and the pixels it painted last
+FlatImage = np.zeros( FLAT_IMAGE_SHAPE )
+FlatImagePainted = np.zeros( 0, dtype=np.int64 )
+
+def PaintFlatImage( tubes, quantities, cutrange=[-1,-1] ):
+    """
+    Returns the flat cylinder image of the quantities of the hit tubes,
+    painted with one scatter of their PMTFlatStencils into FlatImage.
+    Only the pixels of the previous event are cleared, so the image is not
+    allocated or zeroed for each event. Where tubes overlap the last hit
+    wins. Hits outside cutrange are not painted (unless both values are
+    the same).
+    """
+    global FlatImagePainted
+    flat = FlatImage.reshape( -1 )
+    flat[ FlatImagePainted ] = 0.
+    tubes = np.asarray( tubes )
+    quantities = np.asarray( quantities )
+    if cutrange[0] != cutrange[1]:
+        keep = ( quantities >= cutrange[0] ) & ( quantities <= cutrange[1] )
+        tubes, quantities = tubes[ keep ], quantities[ keep ]
+    pixels = PMTFlatStencils[ tubes ]
+    if ( pixels < 0 ).any():
+        raise KeyError( "tubes not in the geometry: "+str( np.unique( tubes[ (pixels<0).any(axis=1) ] ) ) )
+    flat[ pixels ] = quantities[ :, None ]
+    FlatImagePainted = pixels.reshape( -1 )
+    return FlatImage
+
 def EventDisplay( tubes, quantities, title="Charge", cutrange=[-1,-1] ):
     """
     tubes == np.array of PMTs that were hit
@@ -364,31 +716,29 @@ def EventDisplay( tubes, quantities, title="Charge", cutrange=[-1,-1] ):
     """
     
     fig = plt.figure(figsize=[10,8]) 
-    preimage = np.zeros( [2506, 2317] )
-    imgmin = quantities.min()
-    imgmax = quantities.max()
-    for idx, tube in enumerate( tubes ):
-        if cutrange[0] != cutrange[1]:
-            if quantities[idx] < cutrange[0] or quantities[idx] > cutrange[1]:
-                continue
-        for dx in range(-3,4):
-            for dy in range(-3,4):
-                if abs(dx)==3 and abs(dy)==3:
-                    continue
-                    
-                #print( "idx=", idx, " len(quantities)=",len(quantities), " tube=", tube, " len(PMTFlatMap)=", len(PMTFlatMapPositive))
-                preimage[ PMTFlatMapPositive[tube][1]+dx, PMTFlatMapPositive[tube][0]+dy ] = quantities[idx]
-
-    if cutrange[0] != cutrange[1]:
-        imgmin = cutrange[0]
-        imgmax = cutrange[1]
-    plt.imshow( preimage, extent = [-1162.7,1162.7,-1267.7,1267.7], vmin=imgmin, vmax=imgmax )
+    plt.imshow( np.zeros( FLAT_IMAGE_SHAPE ), extent = [-1162.7,1162.7,-1267.7,1267.7] )
     fig.suptitle(title, fontsize=20)
     plt.xlabel('Distance CCW on perimeter from x-axis (cm)', fontsize=18)
     plt.ylabel('Y (cm)', fontsize=16)
     plt.set_cmap('cubehelix_r')
     plt.colorbar()
+    UpdateEventDisplay( fig, tubes, quantities, title, cutrange )
     return fig
+
+def UpdateEventDisplay( fig, tubes, quantities, title="Charge", cutrange=[-1,-1] ):
+    """
+    Shows another event in a figure made by EventDisplay, by replacing the
+    data, color range and title of its image (same arguments as EventDisplay)
+    """
+    img = fig.axes[0].images[0]
+    img.set_data( PaintFlatImage( tubes, quantities, cutrange ) )
+    imgmin = quantities.min()
+    imgmax = quantities.max()
+    if cutrange[0] != cutrange[1]:
+        imgmin = cutrange[0]
+        imgmax = cutrange[1]
+    img.set_clim( imgmin, imgmax )
+    fig.suptitle( title, fontsize=20 )
     
 
 def ChargeTimeHist( times, charges, title='Event Charge versus Time', cutrange = [[-1,-1],[-1,-1]] ):
@@ -401,6 +751,21 @@ def ChargeTimeHist( times, charges, title='Event Charge versus Time', cutrange =
     cutrange has two ranges, one in x and one in y [ [tmin, tmax], [qmin,qmax] ]
     """
     fig = plt.figure(figsize=[10,8]) 
+    # the 100x100 histogram is drawn as an image, which can be updated
+    plt.imshow( np.zeros( [100,100] ), origin='lower', aspect='auto', interpolation='nearest' )
+    fig.suptitle(title, fontsize=20)
+    plt.xlabel('Time (ns)', fontsize=18)
+    plt.ylabel('Charge (pe)', fontsize=16)
+    plt.set_cmap('cubehelix_r')
+    plt.colorbar()
+    UpdateChargeTimeHist( fig, times, charges, title, cutrange )
+    return fig
+
+def UpdateChargeTimeHist( fig, times, charges, title='Event Charge versus Time', cutrange = [[-1,-1],[-1,-1]] ):
+    """
+    Shows another event in a figure made by ChargeTimeHist, by replacing
+    the histogram, axis ranges and title (same arguments as ChargeTimeHist)
+    """
     tmin = times.min()
     tmax = times.max()
     qmin = charges.min()
@@ -412,55 +777,154 @@ def ChargeTimeHist( times, charges, title='Event Charge versus Time', cutrange =
     if cutrange[1][0] != cutrange[1][1]:
         qmin = cutrange[1][0]
         qmax = cutrange[1][1]
-        
-    plt.hist2d( times, charges, [100,100], [[tmin,tmax],[qmin,qmax]] )
-    fig.suptitle(title, fontsize=20)
-    plt.xlabel('Time (ns)', fontsize=18)
-    plt.ylabel('Charge (pe)', fontsize=16)
-    plt.set_cmap('cubehelix_r')
-    plt.colorbar()
-    return fig
 
+    counts, tedges, qedges = np.histogram2d( times, charges, [100,100], [[tmin,tmax],[qmin,qmax]] )
+    ax = fig.axes[0]
+    img = ax.images[0]
+    img.set_data( counts.T )
+    img.set_extent( ( tedges[0], tedges[-1], qedges[0], qedges[-1] ) )
+    img.set_clim( counts.min(), counts.max() )
+    ax.set_xlim( tedges[0], tedges[-1] )
+    ax.set_ylim( qedges[0], qedges[-1] )
+    fig.suptitle( title, fontsize=20 )
 
-def GetNextEvent( self_frame, entry_ev ):
+
+def MPMTTitle( evno ):
     """
-    Load the next event, and update the current frame's plot with the current event
-    Inputs are the frame to update, and the tk.Entry that holds the event number
+    Title of the mPMT display of event evno of an h5 file
+    """
+    event = datafile.event( evno )
+    return "Event %d: %s, %.1f MeV" % ( evno, LABEL_NAMES[ event['label']+1 ], event['energy'] )
+
+def MPMTGrids( event ):
+    """
+    Returns the 40x40 mPMT grids of the total charge and of the mean time of
+    the hit PMTs (nan without hits) of an h5 event record
+    """
+    charges = event[ 'image' ][ :, :, :19 ]
+    times = event[ 'image' ][ :, :, 19: ]
+    num_hits = np.count_nonzero( charges, axis=2 )
+    with np.errstate( invalid='ignore', divide='ignore' ):
+        mean_times = np.where( num_hits > 0, ( times*(charges != 0) ).sum( axis=2 )/num_hits, np.nan )
+    return charges.sum( axis=2 ), mean_times
+
+def MPMTDisplayFigure( event, title, cutrange=[-1,-1] ):
+    """
+    Makes the figure of the charge and time mPMT grids of an h5 event
+    record (see UpdateMPMTDisplay)
+    """
+    fig = plt.figure(figsize=[14,7])
+    axes = [ fig.add_subplot( 1, 2, i+1 ) for i in range(2) ]
+    for ax, label in zip( axes, ( 'Charge (pe)', 'Mean time (ns)' ) ):
+        img = ax.imshow( np.zeros( [40,40] ), cmap='cubehelix_r' )
+        ax.set_xlabel( 'mPMT column' )
+        ax.set_ylabel( 'mPMT row' )
+        fig.colorbar( img, ax=ax, label=label )
+    UpdateMPMTDisplay( fig, event, title, cutrange )
+    return fig
+
+def UpdateMPMTDisplay( fig, event, title, cutrange=[-1,-1] ):
+    """
+    Shows another event in a figure made by MPMTDisplayFigure. cutrange
+    is the charge color range (or set both same for default)
+    """
+    # the colorbar axes come after the two grids
+    for grid, ax in zip( MPMTGrids( event ), fig.axes[:2] ):
+        img = ax.images[0]
+        img.set_data( grid )
+        if ax is fig.axes[0] and cutrange[0] != cutrange[1]:
+            img.set_clim( cutrange[0], cutrange[1] )
+        elif np.isfinite( grid ).any():
+            img.set_clim( np.nanmin( grid ), np.nanmax( grid ) )
+    fig.suptitle( title, fontsize=20 )
+
+def LoadEvent( evno ):
+    """
+    Makes evno the current event: gets its hits from the event source, and
+    starts reading the events next to it in the background
     """
     global event_number
     global digitubes
     global digicharges
     global digitimes
 
+    event_number = evno
+    event = datafile.event( event_number )
+    digitubes = event[ 'digi_hit_pmt' ]
+    digicharges = event[ 'digi_hit_charge' ]
+    digitimes = event[ 'digi_hit_time' ]
+    datafile.prefetch( event_number )
+
+def ShowEvent( self_frame, evno ):
+    """
+    Load event evno, and update the current frame's plot with it
+    """
+    LoadEvent( evno )
+    self_frame.main_window.event_changed()
+    self_frame.show()
+
+def GoToEvent( self_frame, entry_ev ):
+    """
+    Load the event typed in the tk.Entry entry_ev, and update the current frame's plot
+    """
+    event = int( entry_ev.get() )
+    if 0 <= event < num_events:
+        print("GoToEvent: loading= ",event)
+        ShowEvent( self_frame, event )
+    else:
+        print("GoToEvent: no event",event,"in file of",num_events,"events.")
+
+def GetNextEvent( self_frame, entry_ev ):
+    """
+    Load the next (selected) event, and update the current frame's plot with the current event
+    Inputs are the frame to update, and the tk.Entry that holds the event number
+    """
+    global event_number
+
     print("GetNextEvent: current= ",event_number)
     event = int( entry_ev.get() )
     if event != event_number and event+1 < num_events:
         event_number = event-1
 
+    next_event = datafile.step( event_number, 1 )
+    if next_event is not None:
+        print("GetNextEvent: loading= ",next_event)
+        ShowEvent( self_frame, next_event )
+    else:
+        print("At end of file, no more events to load.")
 
-    if event_number+1 < num_events:
-        event_number += 1
-        print("GetNextEvent: loading= ",event_number)
+def GetPrevEvent( self_frame, entry_ev ):
+    """
+    Load the previous (selected) event, and update the current frame's plot with the current event
+    Inputs are the frame to update, and the tk.Entry that holds the event number
+    """
+    global event_number
+
+    print("GetPrevEvent: current= ",event_number)
+    event = int( entry_ev.get() )
+    if event != event_number and 0 <= event < num_events:
+        event_number = event+1
 
-        digitubes = datafile[ 'digi_hit_pmt' ][ event_number ]
-        digicharges = datafile[ 'digi_hit_charge' ][ event_number ]
-        digitimes = datafile[ 'digi_hit_time' ][ event_number ]
-        self_frame.update_plot() 
+    prev_event = datafile.step( event_number, -1 )
+    if prev_event is not None:
+        print("GetPrevEvent: loading= ",prev_event)
+        ShowEvent( self_frame, prev_event )
     else:
-        print("At end of file, no more events to load.")
+        print("At start of file, no previous event to load.")
 
 def ApplyZrange( self_frame, entry_zmin, entry_zmax ):
     """
     Read the tk.Entry for the zmin and zmax values to set on the plot for the current frame.
     Ignores the QTDisplay frame, since the builder function for that plot doesn't have a z-axis scaling option.
     """
-    if self_frame == QTDisplay:
+    if isinstance( self_frame, QTDisplay ):
         print("Z axis not scalable for QTDisplay")
         return
     zmin = float( entry_zmin.get() )
     zmax = float( entry_zmax.get() )
     print("zmin=",zmin," zmax=",zmax )
-    self_frame.update_plot( [zmin, zmax] )
+    self_frame.set_zrange( [zmin, zmax] )
+    self_frame.show()
 
     
 def GetParticleStartStops( datain, evno ):
@@ -500,39 +964,58 @@ def GetParticleStartStops( datain, evno ):
 
 
 def EventDisplay3D( fig, geo, data, evno, zrange=[-1.,-1.] ):
-
-    partx, party, partz, partid, partene = GetParticleStartStops( data, evno )
-    digitubes = data[ 'digi_hit_pmt' ][ evno ]
-    digicharges = data[ 'digi_hit_charge' ][ evno ]
-    digitimes = data[ 'digi_hit_time' ][ evno ]
-
-    evxyz = geo['position'][ digitubes ]
-
-    
+    """
+    Adds the 3D view of event evno to fig: the hit tubes with time as color
+    and charge as size, and the tracks of the electrons, muons and gammas.
+    """
     ax = fig.add_subplot(111, projection='3d')
     ax.set_xlim3d( -R, R )
     ax.set_ylim3d( -H/2, H/2)
     ax.set_zlim3d( -R, R)
 
-    if zrange[0] == zrange[1]:
-        img = ax.scatter( evxyz[:,0], evxyz[:,1], evxyz[:,2], marker='o', c=digitimes, s=3*digicharges )#, vmin=940 , vmax=1040  )
-    else:
-        img  = ax.scatter( evxyz[:,0], evxyz[:,1], evxyz[:,2], marker='o', c=digitimes, s=3*digicharges , vmin=zrange[0] , vmax=zrange[1]  )
-
-        
+    img = ax.scatter( [], [], [], marker='o', c=[] )
     plt.set_cmap('cubehelix_r')
-    colors = { 11:'r', 13:'g', 22:'c'}
-    for i, pid in enumerate( partid ):
-        ax.plot( partx[i], party[i], partz[i], c=colors[ abs(pid) ] )
-        ax.text( partx[i][0], party[i][0], partz[i][0], "%.1f MeV"%partene[i], color=colors[ abs(pid) ])    
     ax.set_xlabel('X (cm)')
     ax.set_ylabel('Y (cm)')
     ax.set_zlabel('Z (cm)')
-    ax.set_title('Event %d'%evno)
     plt.colorbar(img) 
     ax.text( -400, -400, 550, "electrons are red", c='r' )
     ax.text( -400, -400, 510, "muons are green", c='g' )
     ax.text( -400, -400, 470, "gammas are cyan", c='c' )
+    UpdateEventDisplay3D( fig, geo, data, evno, zrange )
+
+def UpdateEventDisplay3D( fig, geo, data, evno, zrange=[-1.,-1.] ):
+    """
+    Shows event evno in a figure made by EventDisplay3D: moves the points
+    of the existing scatter plot and replaces the tracks.
+    data is the EventSource of the event file.
+    """
+    event = data.event( evno )
+    partx, party, partz, partid, partene = event[ 'tracks' ]
+    digitubes = event[ 'digi_hit_pmt' ]
+    digicharges = event[ 'digi_hit_charge' ]
+    digitimes = event[ 'digi_hit_time' ]
+
+    evxyz = geo['position'][ digitubes ]
+
+    ax = fig.axes[0]
+    img = ax.collections[0]
+    img._offsets3d = ( evxyz[:,0], evxyz[:,1], evxyz[:,2] )
+    img.set_array( np.asarray( digitimes ) )
+    img.set_sizes( 3*np.asarray( digicharges ) )
+    if zrange[0] == zrange[1]:
+        if len( digitimes ) > 0:
+            img.set_clim( digitimes.min(), digitimes.max() )
+    else:
+        img.set_clim( zrange[0], zrange[1] )
+
+    for artist in ax.lines[:] + [ text for text in ax.texts if text.get_gid() == 'track' ]:
+        artist.remove()
+    colors = { 11:'r', 13:'g', 22:'c'}
+    for i, pid in enumerate( partid ):
+        ax.plot( partx[i], party[i], partz[i], c=colors[ abs(pid) ] )
+        ax.text( partx[i][0], party[i][0], partz[i][0], "%.1f MeV"%partene[i], color=colors[ abs(pid) ], gid='track')    
+    ax.set_title('Event %d'%evno)
     
 
 if __name__ == '__main__':
@@ -545,7 +1028,11 @@ if __name__ == '__main__':
     if geofilename is None:
         geofilename =  tk.filedialog.askopenfilename(initialdir = "./",title = "Select geometry file",filetypes = (("npz files","*.npz"),("all files","*.*")))
 
-    if eventfilename is None:
+    h5_mode = os.path.splitext( geofilename )[1].lower() in H5_EXTENSIONS
+    if h5_mode and eventfilename is not None:
+        event_number = int( eventfilename )
+
+    if eventfilename is None and not h5_mode:
         eventfilename =  tk.filedialog.askopenfilename(initialdir = "./",title = "Select event file",filetypes = (("npz files","*.npz"),("all files","*.*")))
 
     print ( "Event file is : ", eventfilename )
@@ -553,30 +1040,36 @@ if __name__ == '__main__':
 
     root.destroy()
 
-    datafile = np.load( eventfilename, allow_pickle=True )
-    #'IWCDmPMT_4pi_full_tank_mu-_E0to1000MeV_unif-pos-R371-y521cm_4pi-dir_3000evts_25.npz',allow_pickle=True)
-    geofile = np.load( geofilename, allow_pickle=True )
-    #'full_geo_dump.npz',allow_pickle=True)
-
-    tubes = geofile[ 'tube_no' ]
-    tube_xyz = geofile[ 'position' ]
-    tube_x = tube_xyz[:,0]
-    tube_y = tube_xyz[:,1]
-    R =  (tube_x.max() - tube_x.min())/2.0
-    H =  (tube_y.max() - tube_y.min())
-    print("R=",R, "H=",H)
-
-    PMTFlatMapPositive = PMT_to_flat_cylinder_map_positive( tubes, tube_xyz )
-
-    num_events = len( datafile[ 'digi_hit_pmt' ] )
+    if h5_mode:
+        if h5py is None:
+            sys.exit( "h5py and preprocessing/endcaps_h5_reader.py are needed to show h5 files" )
+        # no geometry: the events are already on the mPMT grid
+        datafile = H5EventSource( geofilename )
+    else:
+        datafile = EventSource( np.load( eventfilename, allow_pickle=True ) )
+        #'IWCDmPMT_4pi_full_tank_mu-_E0to1000MeV_unif-pos-R371-y521cm_4pi-dir_3000evts_25.npz',allow_pickle=True)
+        # decode the geometry arrays once, not for every event
+        geofile = dict( np.load( geofilename, allow_pickle=True ) )
+        #'full_geo_dump.npz',allow_pickle=True)
+
+        tubes = geofile[ 'tube_no' ]
+        tube_xyz = geofile[ 'position' ]
+        tube_x = tube_xyz[:,0]
+        tube_y = tube_xyz[:,1]
+        R =  (tube_x.max() - tube_x.min())/2.0
+        H =  (tube_y.max() - tube_y.min())
+        print("R=",R, "H=",H)
+
+        PMTFlatMapPositive = PMT_to_flat_cylinder_map_positive( tubes, tube_xyz )
+        PMTFlatStencils = PMT_flat_stencils( PMTFlatMapPositive )
+
+    num_events = len( datafile )
     if event_number >= num_events:
         print("Requested event is beyond number of events in file")
         event_number = num_events-1
         print("Set event number to ",event_number)
     
-    digitubes = datafile[ 'digi_hit_pmt' ][ event_number ]
-    digicharges = datafile[ 'digi_hit_charge' ][ event_number ]
-    digitimes = datafile[ 'digi_hit_time' ][ event_number ]
+    LoadEvent( event_number )
 
 
 
@@ -1,11 +1,157 @@
 import os
 import h5py
+import json
+import time
+import pstats
+import struct
+import cProfile
+import hashlib
 import argparse
+import contextlib
+import collections
+import multiprocessing
 import numpy as np
 
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+try:
+    # Only for the peak memory reported with --profile and --profile-json
+    import resource
+except ImportError:
+    resource = None
+
 IMAGE_SHAPE = (40,40,38)
 PMT_LABELS = "PMT label - Sheet3.csv"
 
+# Output datasets: name -> (per-event shape, dtype)
+DATASETS = {
+    "event_data": (IMAGE_SHAPE, np.dtype(np.float32)),
+    "labels": ((), np.dtype(np.int32)),
+    "energies": ((1,), np.dtype(np.float32)),
+    "positions": ((1, 3), np.dtype(np.float32)),
+    "event_ids": ((), np.dtype(np.int32)),
+    "root_file_index": ((), np.dtype(np.int32)),
+    "angles": ((2,), np.dtype(np.float32)),
+    # Only with --trigger-mode separate: position of the event's trigger in
+    # time order, 0 for the first trigger
+    "trigger_index": ((), np.dtype(np.int32)),
+}
+# Columns of the event summary table, one value per event, for selecting
+# events without reading event_data. radius is the distance from the tank
+# axis (y), nhits and total_charge are over the pixels of the image.
+# The columns are also output datasets, named event_summary/<column>.
+EVENT_SUMMARY = "event_summary"
+SUMMARY_COLUMNS = {
+    "energy": np.dtype(np.float32),
+    "x": np.dtype(np.float32),
+    "y": np.dtype(np.float32),
+    "z": np.dtype(np.float32),
+    "radius": np.dtype(np.float32),
+    "polar": np.dtype(np.float32),
+    "azimuth": np.dtype(np.float32),
+    "nhits": np.dtype(np.int32),
+    "total_charge": np.dtype(np.float32),
+    "label": np.dtype(np.int32),
+}
+DATASETS.update((EVENT_SUMMARY+"/"+name, ((), dtype))
+                for name, dtype in SUMMARY_COLUMNS.items())
+# root_file_index points into this table of the distinct root file paths
+ROOT_FILE_TABLE = "root_file_table"
+
+# Hit datasets of the sparse output format, which replace event_data.
+# The hits of event i are [event_hits_offset[i], event_hits_offset[i+1]),
+# hit_index is the flat index of the hit's charge channel in an IMAGE_SHAPE
+# image and the time channel is 19 further.
+HIT_DATASETS = {
+    "hit_index": np.dtype(np.int32),
+    "hit_charge": np.dtype(np.float32),
+    "hit_time": np.dtype(np.float32),
+}
+HIT_CHUNKS = 65536
+OUTPUT_FORMATS = ("dense", "sparse", "npy")
+# With several workers the files come back as hit lists and their dense
+# images are built and written by the main process this many events at a time
+WORKER_BLOCK_EVENTS = 256
+
+# Handling of the triggers of an event. first keeps the hits of the first
+# trigger in time, separate writes each trigger with hits as its own event
+# and channels stacks the triggers of an event in IMAGE_SHAPE[2] channels each
+# (see image_shape_for).
+TRIGGER_MODES = ("first", "separate", "channels")
+
+# Stages of the conversion timed by Instrumentation: load, select, build and
+# metadata are the steps of process_file (reading the hit arrays, selecting
+# the hits of the triggers, building the images or hit lists with their
+# statistics, reading the labels and truth), prescan is count_events, write
+# is write_events, record the statistics and progress rows, and finalize the
+# totals, selection index and splits written at the end.
+STAGES = ("prescan", "load", "select", "build", "metadata", "write", "record",
+          "finalize")
+
+# Data quality statistics collected while converting, one row per input file
+# (see file_statistics). The hit statistics are over the selected hits (in
+# the first trigger by default), before hits on the same pixel are merged.
+# The histograms have an underflow bin before the first edge and an overflow
+# bin after the last.
+STATISTICS = "statistics"
+CHARGE_HIST_EDGES = np.linspace(0., 100., 201)
+TIME_HIST_EDGES = np.linspace(0., 2000., 201)
+# label_counts are the counts of labels -1 (unknown pid), 0, 1 and 2
+LABEL_NAMES = ("unknown", "gamma", "electron", "muon")
+FILE_STATISTICS = {
+    "num_input_events": ((), np.dtype(np.int64)),
+    "num_events": ((), np.dtype(np.int64)),
+    "num_raw_hits": ((), np.dtype(np.int64)),
+    "num_hits": ((), np.dtype(np.int64)),
+    "label_counts": ((len(LABEL_NAMES),), np.dtype(np.int64)),
+    "charge_hist": ((len(CHARGE_HIST_EDGES)+1,), np.dtype(np.int64)),
+    "time_hist": ((len(TIME_HIST_EDGES)+1,), np.dtype(np.int64)),
+    "charge_range": ((2,), np.dtype(np.float32)),
+    "time_range": ((2,), np.dtype(np.float32)),
+    # Hits on each charge channel of the image
+    "occupancy": (IMAGE_SHAPE[:2]+(19,), np.dtype(np.int32)),
+    # Moments of each of the image channels over the pixels with a hit, of
+    # the values in the float32 images before any quantization, for
+    # normalization (see channel_moments). m2 is the sum of squared
+    # deviations from the mean.
+    "hit_count": ((IMAGE_SHAPE[2],), np.dtype(np.int64)),
+    "hit_mean": ((IMAGE_SHAPE[2],), np.dtype(np.float64)),
+    "hit_m2": ((IMAGE_SHAPE[2],), np.dtype(np.float64)),
+    "hit_min": ((IMAGE_SHAPE[2],), np.dtype(np.float64)),
+    "hit_max": ((IMAGE_SHAPE[2],), np.dtype(np.float64)),
+}
+MOMENTS = ("count", "mean", "m2", "min", "max")
+
+# Index datasets of the train, validation and test splits. The events of
+# each label (LABEL_NAMES without unknown) are also indexed, see make_splits
+SPLITS = ("train_idxs", "val_idxs", "test_idxs")
+
+# Storage types of the charges and times in event_data (or hit_charge and
+# hit_time). uint16 values are scaled, see quantize.
+EVENT_DTYPES = ("float32", "float16", "uint16")
+
+# Size of the header of the .npy files of the npy format. It is fixed so
+# the shape can be rewritten in place as the arrays grow.
+NPY_HEADER_SIZE = 128
+
+# Storage layouts of the output datasets. chunk_events is the number of
+# events in an event_data chunk (None for contiguous datasets, which need
+# the event count up front). Compressed profiles also apply their filter
+# to the other datasets. lz4 needs the hdf5plugin package.
+STORAGE_PROFILES = {
+    "contiguous": {"chunk_events": None},
+    "chunked": {"chunk_events": 1},
+    "event-gzip": {"chunk_events": 1, "compression": "gzip",
+                   "compression_opts": 4, "shuffle": True},
+    "event-lz4": {"chunk_events": 1, "compression": "lz4", "shuffle": True},
+    "batch": {"chunk_events": 32},
+    "batch-gzip": {"chunk_events": 32, "compression": "gzip",
+                   "compression_opts": 4, "shuffle": True},
+}
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Merges numpy arrays; outputs hdf5 file")
@@ -15,24 +161,130 @@ def parse_args():
                         each file on a different line.")
     parser.add_argument('output_file', type=str, nargs=1,
                         help="Path to output file.")  
+    parser.add_argument('--prescan', action='store_true',
+                        help="Count the events in a first pass over the input\
+                        files and create fixed-size datasets. By default the\
+                        files are read once and appended to resizable datasets.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes used to load the input files\
+                        and select their hits. The output is written by the\
+                        main process in input file order, building the dense\
+                        images from the hit lists of the workers.")
+    parser.add_argument('--format', type=str, default="dense",
+                        choices=OUTPUT_FORMATS, dest="output_format",
+                        help="dense writes the (N,40,40,38) event_data dataset,\
+                        sparse writes the hit lists hit_index, hit_charge and\
+                        hit_time with the per-event event_hits_offset instead.\
+                        npy writes the datasets as .npy files in the output\
+                        directory, with a manifest.json, for memory-mapped reads.")
+    parser.add_argument('--trigger-mode', type=str, default="first",
+                        choices=TRIGGER_MODES,
+                        help="Keep the hits of the first trigger of each event,\
+                        write each trigger as its own event (with a\
+                        trigger_index dataset) or stack the triggers in extra\
+                        channels of the images.")
+    parser.add_argument('--max-triggers', type=int, default=None,
+                        help="Number of triggers kept in time order, for the\
+                        separate (default: all) and channels (default: 2)\
+                        trigger modes.")
+    parser.add_argument('--event-dtype', type=str, default="float32",
+                        choices=EVENT_DTYPES,
+                        help="Storage type of the charges and times. uint16\
+                        stores round((value - offset) / scale) with the scales\
+                        and offsets below, which are saved as attributes.")
+    parser.add_argument('--charge-scale', type=float, default=0.01,
+                        help="Charge of one uint16 step (pe). uint16 stores\
+                        charges from offset to offset + 65535 * scale, 0 to\
+                        655 pe by default.")
+    parser.add_argument('--charge-offset', type=float, default=0.,
+                        help="Charge of uint16 value 0 (pe).")
+    parser.add_argument('--time-scale', type=float, default=0.05,
+                        help="Time of one uint16 step (ns). uint16 stores times\
+                        from offset to offset + 65535 * scale, 0 to 3277 ns by\
+                        default, which misses later triggers: use a larger\
+                        scale with --trigger-mode separate or channels. Values\
+                        outside the range are clipped, with a warning.")
+    parser.add_argument('--time-offset', type=float, default=0.,
+                        help="Time of uint16 value 0 (ns).")
+    parser.add_argument('--storage-profile', type=str, default="chunked",
+                        choices=sorted(STORAGE_PROFILES),
+                        help="Chunking and compression of the datasets.\
+                        contiguous implies --prescan.")
+    parser.add_argument('--max-memory', type=float, default=None,
+                        help="Memory budget in MB for dense event_data. Files\
+                        are reduced to hit lists and the images are built\
+                        and written in blocks that fit in the budget, instead\
+                        of building the images of a whole file at once.\
+                        Ignored for sparse output, which has no event_data.")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue an existing output file: files that\
+                        were already converted are skipped and the others\
+                        are appended. The output format and storage profile\
+                        of the existing file are kept.")
+    parser.add_argument('--shard-size', type=int, default=None,
+                        help="Number of input files per shard. Each shard is\
+                        written to its own file (output_0000.h5, ...) and the\
+                        output file holds virtual datasets joining them.")
+    parser.add_argument('--shard-id', type=int, default=None,
+                        help="Only write this shard, so shards can be written\
+                        by separate jobs. Build the index with --index-only\
+                        once all shards are written.")
+    parser.add_argument('--index-only', action='store_true',
+                        help="Only write the virtual dataset index of the\
+                        existing shards.")
+    parser.add_argument('--mapping-cache', type=str, default=None,
+                        help="Directory of the cached PMT to image lookup table\
+                        (default: the directory of the PMT label csv).")
+    parser.add_argument('--chunk-events', type=int, default=None,
+                        help="Number of events per event_data chunk, overrides\
+                        the value of the storage profile.")
+    parser.add_argument('--split-fractions', type=float, nargs=3,
+                        default=(0.8, 0.1, 0.1), metavar=("TRAIN", "VAL", "TEST"),
+                        help="Fractions of the events of each label in the\
+                        train_idxs, val_idxs and test_idxs datasets.")
+    parser.add_argument('--split-seed', type=int, default=0,
+                        help="Seed of the random split.")
+    parser.add_argument('--split-chunk-events', type=int, default=1,
+                        help="Split the events in blocks of this many events,\
+                        so that each split reads whole blocks (use the\
+                        event_data chunk size).")
+    parser.add_argument('--profile', action='store_true',
+                        help="Print the rates, estimated time left and peak\
+                        memory after each file, and the time of each stage\
+                        at the end.")
+    parser.add_argument('--profile-json', type=str, default=None,
+                        help="Append the profile of each file and of the whole\
+                        conversion to this file as JSON lines.")
+    parser.add_argument('--cprofile', type=str, default=None,
+                        help="Run the conversion under cProfile and write the\
+                        stats to this file (use --workers 1 to include\
+                        the processing of the files).")
     args = parser.parse_args()
+    if args.max_triggers is not None and args.max_triggers < 1:
+        parser.error("--max-triggers must be at least 1")
+    if args.max_triggers is not None and args.trigger_mode == "first":
+        parser.error("--max-triggers only applies to the separate and channels"
+                     " trigger modes")
     return args
 
-def count_events(files):
+def count_events(files, trigger_mode="first", max_triggers=None):
     # Because we want to remove events with 0 hits, 
     # we need to count the events beforehand (to create the h5 file).
-    # This function counts and indexes the events with more than 0 hits.
+    # This function counts and indexes the events with hits in their first
+    # trigger (or the triggers of trigger_mode), the same selection as the
+    # conversion itself.
     # Files need to be iterated in the same order to use the indexes.
     num_events = 0
     nonzero_file_events = []
-    for file_index, f in enumerate(files):
+    max_triggers = kept_triggers(trigger_mode, max_triggers)
+    for f in files:
         data = np.load(f, allow_pickle=True)
-        nonzero_file_events.append([])
-        hits = data['digi_hit_pmt']
-        for i in range(len(hits)):
-            if len(hits[i]) != 0:
-                nonzero_file_events[file_index].append(i)
-                num_events += 1
+        _, hit_events, hit_ranks, num_file_events = select_triggers(
+            data['digi_hit_trigger'], data['trigger_time'], max_triggers)
+        file_indices = trigger_rows(hit_events, hit_ranks, num_file_events,
+                                    trigger_mode == "separate")[0]
+        nonzero_file_events.append(file_indices.tolist())
+        num_events += len(file_indices)
     return (num_events, nonzero_file_events)
 
 def GenMapping(csv_file):
@@ -49,11 +301,1602 @@ def GenMapping(csv_file):
                 value = value.strip()
                 if value: # If the value is not empty
                     mPMT_to_index[int(value)] = [col, row]
-    npmap = np.zeros((max(mPMT_to_index)+1,2),dtype=np.int)
+    npmap = np.zeros((max(mPMT_to_index)+1,2),dtype=int)
     for k, v in mPMT_to_index.items():
         npmap[k]=v
     return npmap
 
+def load_pmt_lookup(csv_file, cache_dir=None):
+    """
+    Returns an array mapping each PMT number to the flat index of its charge
+    channel in an IMAGE_SHAPE image (the time channel is 19 further), built
+    from the mPMT positions in csv_file with GenMapping. The table is cached
+    in cache_dir (default: next to csv_file) in a .npy file named after a hash
+    of the csv contents, so it is only rebuilt when the csv changes.
+    """
+    with open(csv_file, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:16]
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(csv_file))
+    cache_file = os.path.join(cache_dir, "{}.{}.npy".format(
+        os.path.splitext(os.path.basename(csv_file))[0], digest))
+    if os.path.exists(cache_file):
+        return np.load(cache_file)
+
+    mPMT_to_index = GenMapping(csv_file)
+    pmts = np.arange(len(mPMT_to_index)*19)
+    hit_mpmts = pmts // 19
+    pmt_to_pixel = np.ravel_multi_index((mPMT_to_index[hit_mpmts,0],
+                                         mPMT_to_index[hit_mpmts,1],
+                                         pmts % 19), IMAGE_SHAPE).astype(np.int32)
+    try:
+        # Write to a temporary name first, so concurrent jobs never read a
+        # partial file
+        tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.save(f, pmt_to_pixel)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print("Could not cache the PMT mapping in {}: {}".format(cache_dir, e))
+    return pmt_to_pixel
+
+def storage_options(profile, chunks):
+    """
+    Returns the create_dataset keyword arguments of a storage profile for a
+    dataset with the given chunk shape (or True to let h5py choose).
+    """
+    settings = STORAGE_PROFILES[profile]
+    if settings["chunk_events"] is None:
+        return {}
+    options = {"chunks": chunks, "shuffle": settings.get("shuffle", False)}
+    if settings.get("compression") == "lz4":
+        if hdf5plugin is None:
+            raise ImportError("The {} storage profile needs the hdf5plugin"
+                              " package".format(profile))
+        options.update(hdf5plugin.LZ4())
+    elif settings.get("compression") is not None:
+        options["compression"] = settings["compression"]
+        options["compression_opts"] = settings.get("compression_opts")
+    return options
+
+def create_datasets(h5_file, num_events=None, output_format="dense",
+                    storage_profile="chunked", chunk_events=None,
+                    quantization=None, trigger_mode="first", max_triggers=None):
+    """
+    Creates the output datasets. If num_events is given the datasets have a
+    fixed size, otherwise they start empty and grow as events are appended.
+    The hit datasets of the sparse format always grow.
+    storage_profile is one of STORAGE_PROFILES, and chunk_events overrides
+    the number of events per event_data chunk of the profile.
+    quantization (see quantization_from_args) sets the type of the charges
+    and times and is stored in their attributes. trigger_mode and
+    max_triggers set the image shape and the trigger_index dataset.
+    """
+    image_shape = image_shape_for(trigger_mode, max_triggers)
+    if chunk_events is None:
+        chunk_events = STORAGE_PROFILES[storage_profile]["chunk_events"]
+    elif STORAGE_PROFILES[storage_profile]["chunk_events"] is None:
+        raise ValueError("chunk_events can't be used with a contiguous profile")
+    if chunk_events is None and num_events is None:
+        raise ValueError("Contiguous datasets need the number of events")
+    if num_events is not None and chunk_events is not None:
+        # Chunks can't be larger than a fixed-size dataset
+        chunk_events = max(1, min(chunk_events, num_events))
+
+    event_dtype = np.dtype(quantization["dtype"] if quantization else np.float32)
+    dsets = {}
+    for name, (shape, dtype) in DATASETS.items():
+        if name == "event_data" and output_format == "sparse":
+            continue
+        if name == "trigger_index" and trigger_mode != "separate":
+            continue
+        if name == "event_data":
+            shape, dtype = image_shape, event_dtype
+        chunks = (chunk_events,)+shape if name == "event_data" else True
+        options = storage_options(storage_profile, chunks)
+        if num_events is None:
+            dsets[name] = h5_file.create_dataset(name,
+                                                 shape=(0,)+shape,
+                                                 maxshape=(None,)+shape,
+                                                 dtype=dtype,
+                                                 **options)
+        else:
+            dsets[name] = h5_file.create_dataset(name,
+                                                 shape=(num_events,)+shape,
+                                                 dtype=dtype,
+                                                 **options)
+    if output_format == "sparse":
+        # The hit datasets grow, so they are chunked even in contiguous files
+        hit_options = storage_options(storage_profile, (HIT_CHUNKS,)) or {
+            "chunks": (HIT_CHUNKS,)}
+        h5_file.attrs["image_shape"] = image_shape
+        for name, dtype in HIT_DATASETS.items():
+            if name != "hit_index":
+                dtype = event_dtype
+            dsets[name] = h5_file.create_dataset(name, shape=(0,),
+                                                 maxshape=(None,),
+                                                 dtype=dtype,
+                                                 **hit_options)
+        if num_events is None:
+            dsets["event_hits_offset"] = h5_file.create_dataset(
+                "event_hits_offset", shape=(1,), maxshape=(None,),
+                dtype=np.int64, **storage_options(storage_profile, True))
+        else:
+            dsets["event_hits_offset"] = h5_file.create_dataset(
+                "event_hits_offset", shape=(num_events+1,), dtype=np.int64,
+                **storage_options(storage_profile, True))
+    dsets[ROOT_FILE_TABLE] = h5_file.create_dataset(
+        ROOT_FILE_TABLE, shape=(0,), maxshape=(None,),
+        dtype=h5py.special_dtype(vlen=str))
+    if quantization is not None:
+        h5_file.attrs["quantization"] = json.dumps(quantization)
+        for name, attrs in quantization_attrs(quantization).items():
+            if name in dsets:
+                dsets[name].attrs.update(attrs)
+    h5_file.attrs["output_format"] = output_format
+    h5_file.attrs["storage_profile"] = storage_profile
+    h5_file.attrs["trigger_mode"] = trigger_mode
+    h5_file.attrs["max_triggers"] = kept_triggers(trigger_mode, max_triggers) or 0
+    create_progress(h5_file)
+    create_statistics(h5_file, num_channels=image_shape[2])
+    return dsets
+
+def open_datasets(h5_file):
+    """
+    Returns the output datasets of an existing file, as create_datasets does.
+    """
+    names = [n for n in DATASETS if n != "trigger_index" or n in h5_file]
+    if h5_file.attrs["output_format"] == "sparse":
+        names = [n for n in names if n != "event_data"]
+        names += list(HIT_DATASETS) + ["event_hits_offset"]
+    return {name: h5_file[name] for name in names + [ROOT_FILE_TABLE]}
+
+def create_progress(h5_file):
+    """
+    Creates the progress group, which records each converted input file with
+    the offset of the event after its last one, in the order they were written.
+    """
+    progress = h5_file.create_group("progress")
+    progress.create_dataset("files", shape=(0,), maxshape=(None,),
+                            dtype=h5py.special_dtype(vlen=str))
+    progress.create_dataset("offsets", shape=(0,), maxshape=(None,),
+                            dtype=np.int64)
+
+def read_progress(h5_file):
+    """
+    Returns the converted input files and the offset after the last of them.
+    """
+    progress = h5_file["progress"]
+    files = [f.decode() if isinstance(f, bytes) else f
+             for f in progress["files"][...]]
+    offsets = progress["offsets"][...]
+    return files, int(offsets[-1]) if len(offsets) else 0
+
+def record_progress(h5_file, filename, offset):
+    """
+    Records that filename was converted and that its events end at offset,
+    and flushes the file so the record survives a killed job.
+    """
+    progress = h5_file["progress"]
+    num = progress["files"].shape[0]
+    for name, value in (("files", filename), ("offsets", offset)):
+        progress[name].resize(num+1, axis=0)
+        progress[name][num] = value
+    h5_file.flush()
+
+def file_statistics_shapes(num_channels=IMAGE_SHAPE[2]):
+    """
+    Returns FILE_STATISTICS with the hit moments of images with
+    num_channels channels.
+    """
+    return {name: ((num_channels,), dtype) if name.startswith("hit_") else (shape, dtype)
+            for name, (shape, dtype) in FILE_STATISTICS.items()}
+
+def create_statistics(h5_file, files=(), rows=None, num_channels=IMAGE_SHAPE[2]):
+    """
+    Creates the statistics group with a resizable dataset for each of
+    FILE_STATISTICS and one for the input files, optionally filled with
+    the rows of files. The histogram edges are attributes of the group.
+    """
+    group = h5_file.create_group(STATISTICS)
+    group.attrs["charge_hist_edges"] = CHARGE_HIST_EDGES
+    group.attrs["time_hist_edges"] = TIME_HIST_EDGES
+    group.attrs["label_names"] = LABEL_NAMES
+    group.create_dataset("files", data=list(files), maxshape=(None,),
+                         dtype=h5py.special_dtype(vlen=str))
+    for name, (shape, dtype) in file_statistics_shapes(num_channels).items():
+        if rows:
+            shape = rows[name].shape[1:]
+        data = rows[name] if rows else np.zeros((0,)+shape, dtype=dtype)
+        group.create_dataset(name, data=data, maxshape=(None,)+shape,
+                             chunks=(1,)+shape if name == "occupancy" else True)
+    return group
+
+def record_statistics(group, filename, statistics):
+    """
+    Appends the statistics of one input file, before its progress record.
+    """
+    num = group["files"].shape[0]
+    group["files"].resize(num+1, axis=0)
+    group["files"][num] = filename
+    for name in FILE_STATISTICS:
+        group[name].resize(num+1, axis=0)
+        group[name][num] = statistics[name]
+
+def truncate_statistics(group, num_files):
+    """
+    Drops the statistics of the files after the first num_files.
+    """
+    for name in ("files",) + tuple(FILE_STATISTICS):
+        group[name].resize(num_files, axis=0)
+
+def read_statistics(group):
+    """
+    Returns the input files and a dictionary with the rows of
+    FILE_STATISTICS of the statistics group.
+    """
+    files = list(group["files"].asstr()[...])
+    return files, {name: group[name][...] for name in FILE_STATISTICS}
+
+def channel_moments(channels, values, num_channels=IMAGE_SHAPE[2]):
+    """
+    Returns the count, mean, m2 (sum of squared deviations from the mean),
+    min and max of the values of each channel, computed in float64 with two
+    passes. Channels without values have mean and m2 0, min inf and max -inf.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    count = np.bincount(channels, minlength=num_channels)
+    sums = np.bincount(channels, weights=values, minlength=num_channels)
+    mean = np.divide(sums, count, out=np.zeros(num_channels), where=count > 0)
+    m2 = np.bincount(channels, weights=(values - mean[channels])**2,
+                     minlength=num_channels)
+    minimum = np.full(num_channels, np.inf)
+    maximum = np.full(num_channels, -np.inf)
+    np.minimum.at(minimum, channels, values)
+    np.maximum.at(maximum, channels, values)
+    return {"count": count, "mean": mean, "m2": m2, "min": minimum, "max": maximum}
+
+def merge_moments(a, b):
+    """
+    Combines the channel_moments of two sets of values with the pairwise
+    update of Chan et al., which gives the moments of the union.
+    """
+    count = a["count"] + b["count"]
+    delta = b["mean"] - a["mean"]
+    weight = np.divide(b["count"], count, out=np.zeros(len(count)), where=count > 0)
+    return {
+        "count": count,
+        "mean": a["mean"] + delta*weight,
+        "m2": a["m2"] + b["m2"] + delta**2*a["count"]*weight,
+        "min": np.minimum(a["min"], b["min"]),
+        "max": np.maximum(a["max"], b["max"]),
+    }
+
+def hit_moments(hit_pixels, charge, time, num_channels=IMAGE_SHAPE[2]):
+    """
+    Returns the hit_ moments of FILE_STATISTICS of the hits kept in the
+    images, hit_pixels being their flat charge channel index.
+    """
+    channels = hit_pixels % num_channels
+    # The charge and time channels don't overlap, so merging just joins them
+    moments = merge_moments(channel_moments(channels, charge, num_channels),
+                            channel_moments(channels + 19, time, num_channels))
+    return {"hit_"+name: value for name, value in moments.items()}
+
+def total_statistics(rows):
+    """
+    Combines the rows of FILE_STATISTICS of several files. The moments of
+    the files are merged in order, and the moments over all pixels of the
+    images (pixel_) are the hit moments merged with the empty pixels. The
+    standard deviations are added as hit_std and pixel_std.
+    """
+    total = {}
+    for name, (shape, dtype) in FILE_STATISTICS.items():
+        if name.startswith("hit_"):
+            continue
+        elif name.endswith("_range"):
+            valid = rows["num_hits"] > 0
+            values = rows[name][valid]
+            total[name] = (np.array([values[:,0].min(), values[:,1].max()], dtype=dtype)
+                           if len(values) else np.zeros(shape, dtype=dtype))
+        else:
+            total[name] = rows[name].sum(axis=0, dtype=np.int64)
+
+    num_channels = rows["hit_count"].shape[1]
+    hits = channel_moments(np.zeros(0, dtype=np.int64), [], num_channels)
+    for row in range(len(rows["num_events"])):
+        hits = merge_moments(hits, {m: rows["hit_"+m][row] for m in MOMENTS})
+    pixels_per_channel = total["num_events"]*np.prod(IMAGE_SHAPE[:2])
+    empty = pixels_per_channel - hits["count"]
+    pixels = merge_moments(hits, {
+        "count": empty, "mean": np.zeros(num_channels), "m2": np.zeros(num_channels),
+        "min": np.where(empty > 0, 0., np.inf), "max": np.where(empty > 0, 0., -np.inf)})
+    for prefix, moments in (("hit_", hits), ("pixel_", pixels)):
+        for name, value in moments.items():
+            total[prefix+name] = value
+        total[prefix+"std"] = np.sqrt(np.divide(moments["m2"], moments["count"],
+                                                out=np.zeros(num_channels),
+                                                where=moments["count"] > 0))
+    return total
+
+def write_statistics_total(group):
+    """
+    Writes the statistics of all files to the total subgroup, with a dataset
+    for each of FILE_STATISTICS, and returns them.
+    """
+    total = total_statistics(read_statistics(group)[1])
+    if "total" in group:
+        del group["total"]
+    total_group = group.create_group("total")
+    for name, value in total.items():
+        total_group.create_dataset(name, data=value)
+    return total
+
+def print_statistics(total):
+    """
+    Prints the data quality report of the total statistics.
+    """
+    num_events = int(total["num_events"])
+    print("Statistics: {} events written from {} input events"
+          .format(num_events, int(total["num_input_events"])))
+    print("  hits: {} selected of {} in all triggers, {:.1f} per event"
+          .format(int(total["num_hits"]), int(total["num_raw_hits"]),
+                  total["num_hits"]/max(num_events, 1)))
+    print("  charge range: {:.4g} to {:.4g} pe, time range: {:.4g} to {:.4g} ns"
+          .format(*total["charge_range"], *total["time_range"]))
+    for name, edges in (("charge", CHARGE_HIST_EDGES), ("time", TIME_HIST_EDGES)):
+        hist = total[name+"_hist"]
+        if hist[0] or hist[-1]:
+            print("  {} histogram: {} hits below {:g} and {} at or above {:g}"
+                  .format(name, hist[0], edges[0], hist[-1], edges[-1]))
+    print("  labels: "+", ".join("{} {}".format(n, c) for n, c in
+                                  zip(LABEL_NAMES, total["label_counts"])))
+    occupancy = total["occupancy"]
+    print("  channels hit: {} of {}".format(np.count_nonzero(occupancy), occupancy.size))
+
+def make_splits(labels, fractions=(0.8, 0.1, 0.1), seed=0, chunk_events=1):
+    """
+    Returns the sorted indices of the train, validation and test splits of
+    SPLITS, stratified by label, and the indices of each label of
+    LABEL_NAMES. The events of a label are split in blocks of the events of
+    that label in the same chunk of chunk_events events. The blocks are
+    shuffled with seed and assigned in turn, so the splits get the fractions
+    of each label to within a block.
+    """
+    labels = np.asarray(labels)
+    rng = np.random.default_rng(seed)
+    bounds = np.cumsum(fractions)/np.sum(fractions)
+    split_indices = [[np.zeros(0, dtype=np.int64)] for _ in SPLITS]
+    for label in np.unique(labels):
+        indices = np.flatnonzero(labels == label)
+        blocks, block_of_event, block_sizes = np.unique(
+            indices // max(1, chunk_events), return_inverse=True, return_counts=True)
+        order = rng.permutation(len(blocks))
+        # Events of the label before each block in the shuffled order
+        starts = np.empty(len(blocks), dtype=np.int64)
+        starts[order] = np.cumsum(block_sizes[order]) - block_sizes[order]
+        split_of_block = np.searchsorted(np.rint(bounds*len(indices)), starts, side='right')
+        split_of_event = split_of_block[block_of_event]
+        for split, split_list in enumerate(split_indices):
+            split_list.append(indices[split_of_event == split])
+    splits = {name: np.sort(np.concatenate(split_list))
+              for name, split_list in zip(SPLITS, split_indices)}
+    for label, name in enumerate(LABEL_NAMES[1:]):
+        splits[name+"_idxs"] = np.flatnonzero(labels == label)
+    return splits
+
+def write_splits(h5_file, splits, fractions, seed, chunk_events):
+    """
+    Writes the index datasets of make_splits, replacing existing ones, and
+    the split settings as attributes.
+    """
+    for name, indices in splits.items():
+        if name in h5_file:
+            del h5_file[name]
+        h5_file.create_dataset(name, data=indices.astype(np.int64))
+    h5_file.attrs["split_fractions"] = fractions
+    h5_file.attrs["split_seed"] = seed
+    h5_file.attrs["split_chunk_events"] = chunk_events
+
+def summary_orders(columns):
+    """
+    Returns the sort order of each column of the event summary, the indices
+    of the events sorted by the column, which the event selection uses to
+    find the events in a range with a binary search.
+    """
+    orders = {}
+    for name, values in columns.items():
+        index_dtype = np.int32 if len(values) < 2**31 else np.int64
+        orders[name] = np.argsort(values, kind='stable').astype(index_dtype)
+    return orders
+
+def write_summary_orders(h5_file, columns):
+    """
+    Writes the sort orders of the event summary columns, a dictionary of
+    the column arrays, to h5_file as event_summary/order_<column>,
+    replacing existing ones.
+    """
+    summary = h5_file.require_group(EVENT_SUMMARY)
+    for name, order in summary_orders(columns).items():
+        if "order_"+name in summary:
+            del summary["order_"+name]
+        summary.create_dataset("order_"+name, data=order)
+
+def truncate_datasets(dsets, offset):
+    """
+    Drops the events after offset, which were written after the last
+    progress record. Fixed-size datasets are left as they are and the
+    events are overwritten instead. Root files added to the table by the
+    dropped events stay in it, unused.
+    """
+    if "event_hits_offset" in dsets:
+        hit_offset = dsets["event_hits_offset"][offset]
+        for name in HIT_DATASETS:
+            dsets[name].resize(hit_offset, axis=0)
+    for name, dset in dsets.items():
+        if (name in HIT_DATASETS or name == ROOT_FILE_TABLE
+                or dset.maxshape[0] is not None):
+            continue
+        dset.resize(offset+1 if name == "event_hits_offset" else offset, axis=0)
+
+def ragged_concatenate(arrays, dtype=np.int64):
+    """
+    Concatenates a per-event (object) array of arrays.
+    Returns the flat values and the offsets of each event, so that the values
+    of event i are flat[offsets[i]:offsets[i+1]]. Without events the values
+    are an empty array of dtype.
+    """
+    lengths = np.fromiter((len(a) for a in arrays), dtype=np.int64,
+                          count=len(arrays))
+    offsets = np.zeros(len(arrays)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=dtype), offsets
+    return np.concatenate(list(arrays)), offsets
+
+def kept_triggers(trigger_mode, max_triggers=None):
+    """
+    Number of triggers kept in time order by trigger_mode, None for all.
+    """
+    if trigger_mode == "first":
+        return 1
+    if trigger_mode == "channels" and max_triggers is None:
+        return 2
+    return max_triggers
+
+def image_shape_for(trigger_mode, max_triggers=None):
+    """
+    Shape of the images of trigger_mode. In the channels mode the triggers
+    of an event have IMAGE_SHAPE[2] channels each, in time order.
+    """
+    if trigger_mode != "channels":
+        return IMAGE_SHAPE
+    return IMAGE_SHAPE[:2] + (IMAGE_SHAPE[2]*kept_triggers(trigger_mode, max_triggers),)
+
+def select_triggers(digi_hit_trigger, trigger_time, max_triggers=1):
+    """
+    Finds the hits in the first max_triggers triggers in time (all for None)
+    of every event of a file at once. Returns the positions of the hits in
+    the concatenated hits of the file, the event of each of them, the
+    position of their trigger in time order and the number of events in
+    the file.
+    """
+    hit_triggers, hit_offsets = ragged_concatenate(digi_hit_trigger)
+    trigger_times, trigger_offsets = ragged_concatenate(trigger_time, np.float32)
+    num_events = len(hit_offsets) - 1
+    hit_events = np.repeat(np.arange(num_events), np.diff(hit_offsets))
+
+    # Sort the trigger times inside each event. The sort is stable, so ties
+    # go to the lowest trigger number, same as np.argmin
+    trigger_counts = np.diff(trigger_offsets)
+    trigger_events = np.repeat(np.arange(num_events), trigger_counts)
+    order = np.lexsort((trigger_times, trigger_events))
+    trigger_ranks = np.empty(len(order), dtype=np.int64)
+    trigger_ranks[order] = (np.arange(len(order))
+                            - np.repeat(trigger_offsets[:-1], trigger_counts))
+
+    # Hits with a trigger number the event doesn't have are dropped
+    good_hits = np.flatnonzero((hit_triggers >= 0)
+                               & (hit_triggers < trigger_counts[hit_events]))
+    hit_events = hit_events[good_hits]
+    hit_ranks = trigger_ranks[trigger_offsets[hit_events] + hit_triggers[good_hits]]
+    if max_triggers is not None:
+        kept = np.flatnonzero(hit_ranks < max_triggers)
+        good_hits, hit_events, hit_ranks = good_hits[kept], hit_events[kept], hit_ranks[kept]
+    return good_hits, hit_events, hit_ranks, num_events
+
+def trigger_rows(hit_events, hit_ranks, num_events, separate=False):
+    """
+    Returns the output rows of the selected hits: the event of each row in
+    the file, the trigger of each row (its position in time order) and the
+    row of each hit. Rows are the events with hits, or with separate the
+    triggers with hits, in order.
+    """
+    num_ranks = int(hit_ranks.max()) + 1 if separate and len(hit_ranks) else 1
+    keys = hit_events*num_ranks + (hit_ranks if separate else 0)
+    rows = np.flatnonzero(np.bincount(keys, minlength=num_events*num_ranks))
+    key_rows = np.full(num_events*num_ranks, -1, dtype=np.int64)
+    key_rows[rows] = np.arange(len(rows))
+    return rows // num_ranks, rows % num_ranks, key_rows[keys]
+
+def select_trigger_hits(digi_hit_pmt, digi_hit_charge, digi_hit_time,
+                        digi_hit_trigger, trigger_time, pmt_to_pixel,
+                        trigger_mode="first", max_triggers=None):
+    """
+    Selects the hits of trigger_mode (by default the hits in the first
+    trigger) of every event of a file at once. Returns (file_indices,
+    hit_rows, hit_pixels, hit_charge, hit_time, trigger_index) where
+    file_indices are the events of the output rows (see trigger_rows),
+    hit_rows is the row of each hit, hit_pixels is the flat index of the
+    hit's charge channel in an image of image_shape_for(trigger_mode) (the
+    time channel is 19 further) and trigger_index is the trigger of each row.
+    """
+    good_hits, hit_events, hit_ranks, num_events = select_triggers(
+        digi_hit_trigger, trigger_time, kept_triggers(trigger_mode, max_triggers))
+    file_indices, trigger_index, hit_rows = trigger_rows(
+        hit_events, hit_ranks, num_events, trigger_mode == "separate")
+
+    hit_pixels = pmt_to_pixel[ragged_concatenate(digi_hit_pmt)[0][good_hits]]
+    if trigger_mode == "channels":
+        num_channels = image_shape_for(trigger_mode, max_triggers)[2]
+        pixels, channels = np.divmod(hit_pixels, IMAGE_SHAPE[2])
+        hit_pixels = pixels*num_channels + hit_ranks*IMAGE_SHAPE[2] + channels
+    hit_charge = ragged_concatenate(digi_hit_charge, np.float32)[0][good_hits]
+    hit_time = ragged_concatenate(digi_hit_time, np.float32)[0][good_hits]
+    return file_indices, hit_rows, hit_pixels, hit_charge, hit_time, trigger_index
+
+def build_event_images(digi_hit_pmt, digi_hit_charge, digi_hit_time,
+                       digi_hit_trigger, trigger_time, pmt_to_pixel):
+    """
+    Builds the (N,)+IMAGE_SHAPE images of the events of a file with hits in
+    their first trigger, with one scatter for the charges and one for the
+    times. Returns the images and the indices of the events in the file.
+    """
+    selected = select_trigger_hits(digi_hit_pmt, digi_hit_charge,
+                                   digi_hit_time, digi_hit_trigger,
+                                   trigger_time, pmt_to_pixel)[:5]
+    return fill_event_images(*selected), selected[0]
+
+def fill_event_images(file_indices, hit_rows, hit_pixels, charge, time, out=None):
+    """
+    Builds the images of build_event_images from the hits selected by
+    select_trigger_hits, in out if given, which must be zero except at the
+    charge channels of the hits.
+    """
+    x_data = out
+    if x_data is None:
+        x_data = np.zeros((len(file_indices),)+IMAGE_SHAPE,
+                          dtype=DATASETS["event_data"][1])
+    flat = x_data.reshape(-1)
+    hit_pixels = hit_rows*np.prod(x_data.shape[1:]) + hit_pixels
+    flat[hit_pixels] = charge
+    flat[hit_pixels + 19] = time
+    return x_data
+
+def last_hits(images, hit_rows, hit_pixels):
+    """
+    Returns the positions of the hits whose values end up in images, the
+    last hit on each pixel, in pixel order like collect_event_hits so the
+    statistics of the hits add up the same either way. images must be
+    float32 images, they are used as scratch space for the hit numbers,
+    which are left in the charge channels of the hit pixels for
+    fill_event_images to overwrite.
+    """
+    flat = images.reshape(-1).view(np.int32)
+    pixels = hit_rows*np.prod(images.shape[1:]) + hit_pixels
+    hits = np.arange(len(pixels), dtype=np.int32)
+    flat[pixels] = hits
+    last = np.flatnonzero(flat[pixels] == hits)
+    return last[np.argsort(pixels[last])]
+
+def collect_event_hits(file_indices, hit_rows, hit_pixels, charge, time,
+                       image_shape=IMAGE_SHAPE):
+    """
+    Builds the sparse hit lists of the events from the hits selected by
+    select_trigger_hits, for images of image_shape. Returns a dictionary
+    with the HIT_DATASETS arrays and the event_hits_offset of the events
+    (starting at 0). Hits are sorted by pixel within each event and, like in
+    the dense images, only the last hit on a pixel is kept.
+    """
+    keys = hit_rows*np.prod(image_shape) + hit_pixels
+    # np.unique returns the first occurrence, so search the reversed hits
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    hit_rows = hit_rows[last]
+    event_hits_offset = np.zeros(len(file_indices)+1, dtype=np.int64)
+    np.cumsum(np.bincount(hit_rows, minlength=len(file_indices)),
+              out=event_hits_offset[1:])
+    hits = {
+        "hit_index": hit_pixels[last],
+        "hit_charge": charge[last],
+        "hit_time": time[last],
+        "event_hits_offset": event_hits_offset,
+    }
+    return hits
+
+def histogram(values, edges):
+    """
+    Counts the values in the equal-width bins between edges, with an
+    underflow bin first and an overflow bin last.
+    """
+    # Python floats keep float32 values in float32
+    first, last, num_bins = float(edges[0]), float(edges[-1]), len(edges) - 1
+    bins = np.floor((values - first)*(num_bins/(last - first)))
+    np.clip(bins, -1, num_bins, out=bins)
+    return np.bincount(bins.astype(np.intp) + 1, minlength=num_bins+2)
+
+def file_statistics(num_input_events, num_raw_hits, file_indices, hit_rows,
+                    hit_pixels, charge, time, num_channels=IMAGE_SHAPE[2]):
+    """
+    Computes the hit statistics of FILE_STATISTICS of one file from the hits
+    selected by select_trigger_hits for images with num_channels channels.
+    The label counts and moments are added by process_file.
+    """
+    pixels, channels = np.divmod(hit_pixels, num_channels)
+    occupancy = np.bincount(pixels*19 + channels % IMAGE_SHAPE[2],
+                            minlength=np.prod(FILE_STATISTICS["occupancy"][0]))
+    statistics = {
+        "num_input_events": num_input_events,
+        "num_events": len(file_indices),
+        "num_raw_hits": num_raw_hits,
+        "num_hits": len(hit_pixels),
+        "charge_hist": histogram(charge, CHARGE_HIST_EDGES),
+        "time_hist": histogram(time, TIME_HIST_EDGES),
+        "occupancy": occupancy.reshape(FILE_STATISTICS["occupancy"][0]),
+    }
+    for name, values in (("charge_range", charge), ("time_range", time)):
+        statistics[name] = (np.array([values.min(), values.max()])
+                            if len(values) else np.zeros(2))
+    return statistics
+
+def check_event_counts(events):
+    """
+    Checks that all the arrays of the events returned by process_file hold
+    the same number of events, and that the hit offsets match the hits.
+    Raises ValueError otherwise, before anything is written.
+    """
+    num = len(events["labels"])
+    for name in DATASETS:
+        if name in events and len(events[name]) != num:
+            raise ValueError("{} has {} events instead of {}".format(
+                name, len(events[name]), num))
+    if events["statistics"]["num_events"] != num:
+        raise ValueError("Statistics count {} events instead of {}".format(
+            events["statistics"]["num_events"], num))
+    if "event_hits_offset" in events:
+        event_hits_offset = events["event_hits_offset"]
+        if len(event_hits_offset) != num+1:
+            raise ValueError("event_hits_offset has {} entries for {} events"
+                             .format(len(event_hits_offset), num))
+        for name in HIT_DATASETS:
+            if len(events[name]) != event_hits_offset[-1]:
+                raise ValueError("{} has {} hits but event_hits_offset ends at {}"
+                                 .format(name, len(events[name]), event_hits_offset[-1]))
+
+def check_datasets(dsets, offset):
+    """
+    Checks that the output datasets hold offset events and that
+    event_hits_offset matches the hit datasets. Raises ValueError otherwise.
+    """
+    for name, dset in dsets.items():
+        if name in DATASETS and dset.shape[0] != offset:
+            raise ValueError("{} has {} events instead of {}".format(
+                name, dset.shape[0], offset))
+    if "event_hits_offset" in dsets:
+        event_hits_offset = dsets["event_hits_offset"]
+        if event_hits_offset.shape[0] != offset+1:
+            raise ValueError("event_hits_offset has {} entries for {} events"
+                             .format(event_hits_offset.shape[0], offset))
+        num_hits = event_hits_offset[offset]
+        for name in HIT_DATASETS:
+            if dsets[name].shape[0] != num_hits:
+                raise ValueError("{} has {} hits but event_hits_offset ends at {}"
+                                 .format(name, dsets[name].shape[0], num_hits))
+
+def expand_hits(event_hits_offset, hit_index, hit_charge, hit_time,
+                image_shape=IMAGE_SHAPE, out=None):
+    """
+    Expands the hit lists of consecutive events into dense images, the
+    inverse of collect_event_hits. event_hits_offset has one more entry than
+    the number of events and is relative to the start of the hit arrays.
+    The images are written to out if given, which must be zero.
+    """
+    num = len(event_hits_offset) - 1
+    if out is None:
+        out = np.zeros((num,)+tuple(image_shape), dtype=hit_charge.dtype)
+    flat = out.reshape(-1)
+    rows = np.repeat(np.arange(num), np.diff(event_hits_offset))
+    pixels = rows*np.prod(image_shape) + hit_index
+    flat[pixels] = hit_charge
+    flat[pixels + 19] = hit_time
+    return out
+
+def quantization_from_args(config):
+    """
+    Returns the quantization settings of the command line arguments,
+    or None to store float32 charges and times.
+    """
+    if config.event_dtype == "float32":
+        return None
+    quantization = {"dtype": config.event_dtype}
+    if config.event_dtype == "uint16":
+        quantization.update(charge_scale=config.charge_scale,
+                            charge_offset=config.charge_offset,
+                            time_scale=config.time_scale,
+                            time_offset=config.time_offset)
+    return quantization
+
+def quantization_attrs(quantization):
+    """
+    Returns the attributes of the datasets holding quantized charges and
+    times: event_data has the scale and offset of both, hit_charge and
+    hit_time have their own.
+    """
+    if quantization.get("dtype") != "uint16":
+        return {}
+    attrs = {key: quantization[key] for key in ("charge_scale", "charge_offset",
+                                                "time_scale", "time_offset")}
+    return {
+        "event_data": attrs,
+        "hit_charge": {"scale": attrs["charge_scale"], "offset": attrs["charge_offset"]},
+        "hit_time": {"scale": attrs["time_scale"], "offset": attrs["time_offset"]},
+    }
+
+def quantize(values, dtype, scale=1., offset=0.):
+    """
+    Converts charges or times to the storage dtype. For uint16 the values
+    are stored as round((value - offset) / scale), clipped to [1, 65535],
+    and zeros stay 0 so empty pixels stay empty.
+    """
+    dtype = np.dtype(dtype)
+    if dtype != np.uint16:
+        return np.asarray(values).astype(dtype)
+    quantized = np.clip(np.rint((values - offset)/scale), 1, 65535).astype(np.uint16)
+    quantized[values == 0] = 0
+    return quantized
+
+def count_clipped(values, dtype, scale=1., offset=0.):
+    """
+    Number of nonzero values that quantize clips to the range of dtype:
+    more than half a step outside [offset, offset + 65535*scale] for uint16
+    (the smallest values are only raised to one step so they stay nonzero),
+    beyond the largest float16 for float16.
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.float16:
+        return int(np.count_nonzero(np.abs(values) > np.finfo(np.float16).max))
+    if dtype != np.uint16:
+        return 0
+    steps = np.rint((values - offset)/scale)
+    return int(np.count_nonzero(((steps < 0) | (steps > 65535)) & (values != 0)))
+
+def dequantize(values, scale=1., offset=0.):
+    """
+    Inverse of quantize, returns float32 values.
+    """
+    if values.dtype != np.uint16:
+        return values.astype(np.float32, copy=False)
+    dequantized = values*np.float32(scale) + np.float32(offset)
+    dequantized[values == 0] = 0
+    return dequantized
+
+def dequantize_event_data(images, attrs):
+    """
+    Returns float32 images from images stored with quantize. attrs are the
+    attributes of event_data with the scales and offsets of uint16 images.
+    """
+    if images.dtype != np.uint16:
+        return images.astype(np.float32, copy=False)
+    charge_channels = np.arange(images.shape[-1]) % 38 < 19
+    dequantized = np.empty(images.shape, dtype=np.float32)
+    dequantized[..., charge_channels] = dequantize(
+        images[..., charge_channels], attrs["charge_scale"], attrs["charge_offset"])
+    dequantized[..., ~charge_channels] = dequantize(
+        images[..., ~charge_channels], attrs["time_scale"], attrs["time_offset"])
+    return dequantized
+
+def stage_done(timings, stage, start):
+    """
+    Adds the time since start to timings[stage] and returns the current time,
+    the start of the next stage.
+    """
+    now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0.) + now - start
+    return now
+
+def written_bytes(dsets, events):
+    """
+    Number of bytes of the datasets written by write_events for events,
+    including the event_data expanded from the hit lists.
+    """
+    total = sum(events[name].nbytes for name in dsets if name in events)
+    if "event_data" in dsets and "event_data" not in events:
+        dset = dsets["event_data"]
+        total += len(events["labels"])*int(np.prod(dset.shape[1:]))*dset.dtype.itemsize
+    return total
+
+def maxrss_bytes(maxrss):
+    """
+    Converts an ru_maxrss of resource.getrusage or os.wait4 to bytes, it is
+    in kilobytes on Linux and in bytes on macOS.
+    """
+    return maxrss*(1 if os.uname().sysname == "Darwin" else 1024)
+
+def peak_memory():
+    """
+    Returns the peak resident memory in MB of this process and of its
+    finished child processes, or None without the resource module.
+    """
+    if resource is None:
+        return None, None
+    return tuple(maxrss_bytes(resource.getrusage(who).ru_maxrss)/2**20
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+class Instrumentation:
+    """
+    Wall time of each stage of the conversion (see STAGES), events and bytes
+    converted, and the rates, estimated time left and peak memory derived
+    from them. After each file they are printed when report is set and
+    appended to json_file as a JSON line, with a summary line at the end.
+    The stages timed in process_file come back with the events, so they
+    are also counted with --workers, where they add up to more than the
+    wall time. When disabled only the per-file timings are collected.
+    """
+    def __init__(self, num_files, report=False, json_file=None):
+        self.num_files = num_files
+        self.report = report
+        self.json_file = open(json_file, 'a') if json_file else None
+        self.start = time.perf_counter()
+        self.timings = {}
+        self.num_done = 0
+        self.num_events = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager adding the time spent in its block to stage name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage_done(self.timings, name, start)
+
+    def rates(self):
+        """
+        Returns the elapsed time and the events/s, input and output MB/s and
+        estimated seconds left, from the files converted so far.
+        """
+        elapsed = time.perf_counter() - self.start
+        rate = elapsed and 1/elapsed
+        eta = (self.num_files - self.num_done)*elapsed/max(self.num_done, 1)
+        return {"elapsed": elapsed, "events_per_s": self.num_events*rate,
+                "input_mb_per_s": self.input_bytes*rate/1e6,
+                "output_mb_per_s": self.output_bytes*rate/1e6, "eta": eta}
+
+    def file_done(self, filename, num_events, timings, output_bytes):
+        """
+        Records a converted file with its number of events, stage timings
+        and bytes written.
+        """
+        self.num_done += 1
+        self.num_events += num_events
+        input_bytes = os.path.getsize(filename)
+        self.input_bytes += input_bytes
+        self.output_bytes += output_bytes
+        for stage, seconds in timings.items():
+            self.timings[stage] = self.timings.get(stage, 0.) + seconds
+        if not (self.report or self.json_file):
+            return
+        rates = self.rates()
+        peak_rss, peak_children_rss = peak_memory()
+        if self.report:
+            print("  {}/{} files, {:.0f} events/s, {:.1f} MB/s read, {:.1f} MB/s"
+                  " written, {:.0f} s left, peak memory {} MB".format(
+                      self.num_done, self.num_files, rates["events_per_s"],
+                      rates["input_mb_per_s"], rates["output_mb_per_s"],
+                      rates["eta"], "?" if peak_rss is None else round(peak_rss)))
+        self.write_json(dict(type="file", file=filename, events=num_events,
+                             input_bytes=input_bytes, output_bytes=output_bytes,
+                             stages=timings, peak_rss_mb=peak_rss, **rates))
+
+    def write_json(self, record):
+        if self.json_file:
+            self.json_file.write(json.dumps(record)+"\n")
+            self.json_file.flush()
+
+    def close(self):
+        """
+        Prints the time of each stage with report, writes the summary JSON
+        line and closes json_file.
+        """
+        rates = self.rates()
+        peak_rss, peak_children_rss = peak_memory()
+        if self.report:
+            print("Profile: {} files, {} events in {:.1f} s, {:.0f} events/s,"
+                  " {:.1f} MB/s read, {:.1f} MB/s written".format(
+                      self.num_done, self.num_events, rates["elapsed"],
+                      rates["events_per_s"], rates["input_mb_per_s"],
+                      rates["output_mb_per_s"]))
+            for stage in STAGES:
+                if stage in self.timings:
+                    print("  {:>9}: {:8.2f} s {:5.1f}%".format(
+                        stage, self.timings[stage],
+                        100*self.timings[stage]/max(rates["elapsed"], 1e-9)))
+            if peak_rss is not None:
+                print("  peak memory {:.0f} MB, child processes {:.0f} MB".format(
+                    peak_rss, peak_children_rss))
+        self.write_json(dict(type="summary", files=self.num_done, events=self.num_events,
+                             input_bytes=self.input_bytes, output_bytes=self.output_bytes,
+                             stages=self.timings, peak_rss_mb=peak_rss,
+                             peak_children_rss_mb=peak_children_rss, **rates))
+        if self.json_file:
+            self.json_file.close()
+            self.json_file = None
+
+def process_file(filename, pmt_to_pixel, output_format="dense", quantization=None,
+                 trigger_mode="first", max_triggers=None):
+    """
+    Loads one npz file and returns a dictionary with an array for each output
+    dataset, holding only the events with hits in their first trigger, or
+    the triggers of trigger_mode (see select_trigger_hits).
+    With quantization the charges and times are converted with quantize and
+    quantization_error holds the largest round-trip error of each.
+    statistics holds the file's FILE_STATISTICS and timings the wall time
+    of each stage (see STAGES).
+    """
+    timings = {}
+    start = time.perf_counter()
+    data = np.load(filename, allow_pickle=True)
+    hit_arrays = (data['digi_hit_pmt'], data['digi_hit_charge'],
+                  data['digi_hit_time'], data['digi_hit_trigger'],
+                  data['trigger_time'], pmt_to_pixel)
+    start = stage_done(timings, "load", start)
+    *selected, trigger_index = select_trigger_hits(*hit_arrays, trigger_mode,
+                                                   max_triggers)
+    start = stage_done(timings, "select", start)
+    file_indices = selected[0]
+    image_shape = image_shape_for(trigger_mode, max_triggers)
+    num_raw_hits = sum(len(hits) for hits in hit_arrays[0])
+    statistics = file_statistics(len(hit_arrays[0]), num_raw_hits, *selected,
+                                 image_shape[2])
+    if output_format == "sparse" or quantization is not None:
+        events = collect_event_hits(*selected, image_shape)
+        hit_rows = np.repeat(np.arange(len(file_indices)),
+                             np.diff(events["event_hits_offset"]))
+        hit_charge = events["hit_charge"]
+        statistics.update(hit_moments(events["hit_index"], events["hit_charge"],
+                                      events["hit_time"], image_shape[2]))
+    else:
+        x_data = np.zeros((len(file_indices),)+image_shape,
+                          dtype=DATASETS["event_data"][1])
+        last = last_hits(x_data, *selected[1:3])
+        hit_rows, hit_charge = selected[1][last], selected[3][last]
+        statistics.update(hit_moments(selected[2][last], hit_charge,
+                                      selected[4][last], image_shape[2]))
+        events = {"event_data": fill_event_images(*selected, out=x_data)}
+    nhits = np.bincount(hit_rows, minlength=len(file_indices))
+    total_charge = np.bincount(hit_rows, weights=hit_charge, minlength=len(file_indices))
+    del hit_rows, hit_charge
+    if trigger_mode == "separate":
+        events["trigger_index"] = trigger_index
+    if quantization is not None:
+        errors = []
+        clipped = []
+        for name, kind in (("hit_charge", "charge"), ("hit_time", "time")):
+            scale = quantization.get(kind+"_scale", 1.)
+            offset = quantization.get(kind+"_offset", 0.)
+            values = events[name]
+            clipped.append(count_clipped(values, quantization["dtype"], scale, offset))
+            events[name] = quantize(values, quantization["dtype"], scale, offset)
+            error = np.abs(dequantize(events[name], scale, offset) - values)
+            errors.append(float(error.max()) if len(error) else 0.)
+        events["quantization_error"] = tuple(errors)
+        events["quantization_clipped"] = tuple(clipped)
+        if output_format != "sparse":
+            events["event_data"] = expand_hits(events["event_hits_offset"],
+                                               events["hit_index"],
+                                               events["hit_charge"],
+                                               events["hit_time"], image_shape)
+    # Release the decoded hit arrays before loading the rest of the file
+    del hit_arrays, selected
+    start = stage_done(timings, "build", start)
+
+    event_id = data['event_id']
+    root_file = data['root_file']
+    pid = data['pid']
+    position = data['position']
+    direction = data['direction']
+    energy = data['energy']
+
+    # 22 -> gamma, 11 -> electron, 13 -> muon
+    # corresponds to labelling used in CNN with only barrel
+    #IWCDmPMT_4pi_full_tank_gamma_E0to1000MeV_unif-pos-R371-y521cm_4pi-dir_3000evts_329.npz has an event with pid 11 though....
+    #pid_to_label = {22:0, 11:1, 13:2}
+    labels = np.full(pid.shape[0], -1)
+    labels[pid==22] = 0
+    labels[pid==11] = 1
+    labels[pid==13] = 2
+
+    # The few distinct root files of the file, and each event's index into them
+    root_file_table, root_file_index = np.unique(root_file[file_indices],
+                                                 return_inverse=True)
+
+    direction = direction[file_indices]
+    polar = np.arccos(direction[:,1])
+    azimuth = np.arctan2(direction[:,2], direction[:,0])
+
+    statistics["label_counts"] = np.bincount(labels[file_indices] + 1,
+                                             minlength=len(LABEL_NAMES))
+    position = position[file_indices].reshape(-1,3)
+    summary = {
+        "energy": energy[file_indices].reshape(-1),
+        "x": position[:,0],
+        "y": position[:,1],
+        "z": position[:,2],
+        "radius": np.hypot(position[:,0], position[:,2]),
+        "polar": polar,
+        "azimuth": azimuth,
+        "nhits": nhits,
+        "total_charge": total_charge,
+        "label": labels[file_indices],
+    }
+    events.update((EVENT_SUMMARY+"/"+name, values) for name, values in summary.items())
+    stage_done(timings, "metadata", start)
+    events.update({
+        "timings": timings,
+        "statistics": statistics,
+        "labels": labels[file_indices],
+        "energies": energy[file_indices].reshape(-1,1),
+        "positions": position.reshape(-1,1,3),
+        "event_ids": event_id[file_indices],
+        "root_file_table": root_file_table,
+        "root_file_index": root_file_index.reshape(-1),
+        "angles": np.hstack((polar.reshape(-1,1),azimuth.reshape(-1,1))),
+    })
+    return events
+
+def iter_processed_files(files, pmt_to_pixel, workers=1, output_format="dense",
+                         quantization=None, trigger_mode="first", max_triggers=None):
+    """
+    Yields (filename, events) for each input file, in the order of files.
+    With more than one worker the files are processed by a pool of processes
+    while the caller writes the results; at most two files per worker are
+    in flight so finished files don't pile up in memory.
+    """
+    if workers <= 1:
+        for filename in files:
+            yield filename, process_file(filename, pmt_to_pixel, output_format,
+                                         quantization, trigger_mode, max_triggers)
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        pending = collections.deque()
+        for filename in files:
+            pending.append((filename, pool.apply_async(
+                process_file, (filename, pmt_to_pixel, output_format,
+                               quantization, trigger_mode, max_triggers))))
+            if len(pending) >= 2*workers:
+                done, result = pending.popleft()
+                yield done, result.get()
+        while pending:
+            done, result = pending.popleft()
+            yield done, result.get()
+
+def write_event_data_blocks(dset, offset, events, block):
+    """
+    Expands the hit lists returned by process_file for the sparse format into
+    dense images and writes them to event_data starting at offset, one
+    block at a time, so only one block of images is in memory. block is a
+    zero event_data buffer of the events of a block, it is left zero so it
+    can be reused for the next files.
+    """
+    event_hits_offset = events["event_hits_offset"]
+    num = len(event_hits_offset) - 1
+    block_events = len(block)
+    for start in range(0, num, block_events):
+        stop = min(start+block_events, num)
+        first, last = event_hits_offset[start], event_hits_offset[stop]
+        hit_offsets = event_hits_offset[start:stop+1] - first
+        hit_index = events["hit_index"][first:last]
+        images = expand_hits(hit_offsets, hit_index,
+                             events["hit_charge"][first:last],
+                             events["hit_time"][first:last],
+                             dset.shape[1:], block[:stop-start])
+        dset[offset+start:offset+stop] = images
+        # Only the hit pixels need to be cleared before reusing the block
+        expand_hits(hit_offsets, hit_index, 0, 0, dset.shape[1:], images)
+
+def table_root_files(dset_table, root_files):
+    """
+    Returns the indices of root_files in the root file table, appending the
+    ones that are not in it yet.
+    """
+    table = {name: i for i, name in enumerate(dset_table.asstr()[...])}
+    new = [name for name in root_files if name not in table]
+    if new:
+        num = dset_table.shape[0]
+        dset_table.resize(num+len(new), axis=0)
+        dset_table[num:] = new
+        table.update((name, num+i) for i, name in enumerate(new))
+    return np.array([table[name] for name in root_files], dtype=np.int32)
+
+def write_events(dsets, offset, events, block=None):
+    """
+    Writes the events returned by process_file starting at offset, growing
+    resizable datasets as needed. Returns the offset after the last event.
+    Raises a ValueError, before writing anything, when the events don't fit
+    in fixed-size datasets.
+    Dense event_data is built from the hit lists in block, a zero buffer of
+    the events of a block (see write_event_data_blocks), when process_file
+    was called for the sparse format.
+    """
+    check_event_counts(events)
+    offset_next = offset + len(events["labels"])
+    for name, dset in dsets.items():
+        if name in HIT_DATASETS or name == ROOT_FILE_TABLE:
+            continue
+        size = offset_next+1 if name == "event_hits_offset" else offset_next
+        if dset.maxshape[0] is not None and dset.maxshape[0] < size:
+            raise ValueError("The output has a fixed size of {} events (--prescan or"
+                             " contiguous storage), it can't hold {} events".format(
+                                 len(dsets["labels"]), offset_next))
+    root_file_index = table_root_files(dsets[ROOT_FILE_TABLE],
+                                       events["root_file_table"])
+    for name, dset in dsets.items():
+        if name not in DATASETS:
+            continue
+        if dset.shape[0] < offset_next:
+            dset.resize(offset_next, axis=0)
+        if name == "event_data" and name not in events:
+            write_event_data_blocks(dset, offset, events, block)
+        elif name == "root_file_index":
+            dset[offset:offset_next] = root_file_index[events[name]]
+        else:
+            dset[offset:offset_next] = events[name]
+
+    if "event_hits_offset" in dsets:
+        dset_offsets = dsets["event_hits_offset"]
+        hit_offset = dset_offsets[offset]
+        hit_offset_next = hit_offset + len(events["hit_index"])
+        for name in HIT_DATASETS:
+            dsets[name].resize(hit_offset_next, axis=0)
+            dsets[name][hit_offset:hit_offset_next] = events[name]
+        if dset_offsets.shape[0] < offset_next+1:
+            dset_offsets.resize(offset_next+1, axis=0)
+        dset_offsets[offset+1:offset_next+1] = hit_offset + events["event_hits_offset"][1:]
+    return offset_next
+
+class NpyArray:
+    """
+    Growable .npy file with the parts of the h5py dataset interface that
+    write_events uses. The header has a fixed size and is rewritten with the
+    current shape by flush, so the file can be opened with np.load at any
+    checkpoint.
+    """
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shape = (0,)+tuple(shape)
+        self.maxshape = (None,)+tuple(shape)
+        self.chunks = None
+        self.row_bytes = int(np.prod(shape, dtype=np.int64))*self.dtype.itemsize
+        self._file = open(path, 'w+b')
+        self.flush()
+
+    def header(self):
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(self.dtype), self.shape)
+        header = header.ljust(NPY_HEADER_SIZE - 11) + "\n"
+        return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+    def resize(self, size, axis=0):
+        self.shape = (size,)+self.shape[1:]
+        self._file.truncate(NPY_HEADER_SIZE + size*self.row_bytes)
+
+    def __setitem__(self, index, value):
+        start, stop, _ = index.indices(self.shape[0])
+        data = np.ascontiguousarray(np.broadcast_to(
+            np.asarray(value, dtype=self.dtype), (stop-start,)+self.shape[1:]))
+        self._file.seek(NPY_HEADER_SIZE + start*self.row_bytes)
+        self._file.write(data.view(np.uint8))
+
+    def flush(self):
+        self._file.seek(0)
+        self._file.write(self.header())
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+class NpyStringTable(list):
+    """
+    List of str with the parts of the h5py string dataset interface that
+    table_root_files uses. It is stored in the manifest of the npy format.
+    """
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def asstr(self):
+        return self
+
+    def __getitem__(self, index):
+        if index is Ellipsis:
+            return list(self)
+        return list.__getitem__(self, index)
+
+    def resize(self, size, axis=0):
+        del self[size:]
+        self.extend([""]*(size - len(self)))
+
+class NpyExport:
+    """
+    Output directory of the npy format: one .npy file per dataset with the
+    events along the first axis, and a manifest.json listing the arrays, the
+    root file table and the converted input files.
+    """
+    def __init__(self, directory, quantization=None, trigger_mode="first",
+                 max_triggers=None):
+        self.directory = directory
+        self.quantization = quantization
+        self.image_shape = image_shape_for(trigger_mode, max_triggers)
+        self.attrs = {"trigger_mode": trigger_mode,
+                      "max_triggers": kept_triggers(trigger_mode, max_triggers) or 0}
+        os.makedirs(directory, exist_ok=True)
+        self.dsets = {}
+        for name, (shape, dtype) in DATASETS.items():
+            if name == "trigger_index" and trigger_mode != "separate":
+                continue
+            if name == "event_data":
+                shape = self.image_shape
+            if name == "event_data" and quantization is not None:
+                dtype = quantization["dtype"]
+            self.dsets[name] = NpyArray(os.path.join(directory, name.replace("/", ".")+".npy"),
+                                        shape, dtype)
+        self.dsets[ROOT_FILE_TABLE] = NpyStringTable()
+        self.progress = {"files": [], "offsets": []}
+        self.statistics = {name: [] for name in FILE_STATISTICS}
+
+    def record_statistics(self, filename, statistics):
+        """
+        Same as record_statistics for h5 files. The statistics are kept in
+        memory and written to statistics.npz by close.
+        """
+        for name in FILE_STATISTICS:
+            self.statistics[name].append(statistics[name])
+
+    def write_statistics_total(self):
+        """
+        Writes statistics.npz with the rows of every file (in the order of
+        the progress files) and their total, prefixed with total_, and
+        returns the total.
+        """
+        shapes = file_statistics_shapes(self.image_shape[2])
+        rows = {name: np.array(values, dtype=shapes[name][1]).reshape((-1,)+shapes[name][0])
+                for name, values in self.statistics.items()}
+        total = total_statistics(rows)
+        np.savez(os.path.join(self.directory, "statistics.npz"),
+                 files=np.array(self.progress["files"]),
+                 charge_hist_edges=CHARGE_HIST_EDGES,
+                 time_hist_edges=TIME_HIST_EDGES,
+                 **rows, **{"total_"+name: value for name, value in total.items()})
+        return total
+
+    def write_summary_orders(self):
+        """
+        Same as write_summary_orders for h5 files, the orders are written
+        to event_summary_orders.npz.
+        """
+        self.flush()
+        columns = {name: np.load(self.dsets[EVENT_SUMMARY+"/"+name].path, mmap_mode='r')
+                   for name in SUMMARY_COLUMNS}
+        np.savez(os.path.join(self.directory, EVENT_SUMMARY+"_orders.npz"),
+                 **summary_orders(columns))
+
+    def write_splits(self, splits, fractions, seed, chunk_events):
+        """
+        Same as write_splits for h5 files, the indices are written to
+        splits.npz.
+        """
+        np.savez(os.path.join(self.directory, "splits.npz"), **splits)
+        self.attrs.update(split_fractions=list(fractions), split_seed=seed,
+                          split_chunk_events=chunk_events)
+
+    def record_progress(self, filename, offset):
+        """
+        Same as record_progress for h5 files: the manifest is rewritten and
+        all arrays are flushed.
+        """
+        self.progress["files"].append(filename)
+        self.progress["offsets"].append(int(offset))
+        self.flush()
+
+    def flush(self):
+        arrays = {name: dset for name, dset in self.dsets.items()
+                  if isinstance(dset, NpyArray)}
+        for dset in arrays.values():
+            dset.flush()
+        manifest = {
+            "format": "npy",
+            "num_events": arrays["labels"].shape[0],
+            "image_shape": list(self.image_shape),
+            "arrays": {name: {"file": os.path.basename(dset.path),
+                              "dtype": dset.dtype.str,
+                              "shape": list(dset.shape)}
+                       for name, dset in arrays.items()},
+            ROOT_FILE_TABLE: list(self.dsets[ROOT_FILE_TABLE]),
+            "progress": self.progress,
+        }
+        if self.quantization is not None:
+            manifest["quantization"] = self.quantization
+        manifest.update(self.attrs)
+        path = os.path.join(self.directory, "manifest.json")
+        with open(path+".tmp", 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(path+".tmp", path)
+
+    def close(self):
+        self.flush()
+        for dset in self.dsets.values():
+            if isinstance(dset, NpyArray):
+                dset.close()
+
+def convert(files, output_file, config, instrumentation=None):
+    """
+    Converts the npz files into output_file with the options in config (see
+    parse_args). Returns the number of events in the output file. The stages
+    are timed with instrumentation, by default one that reports nothing.
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation(len(files))
+    offset = 0
+    output_format = config.output_format
+    quantization = quantization_from_args(config)
+    trigger_mode, max_triggers = config.trigger_mode, config.max_triggers
+    # Events per file found by the prescan, which the conversion must match
+    expected_events = None
+    if output_format == "npy":
+        if config.resume:
+            raise ValueError("--resume is not supported for the npy format")
+        h5_file = NpyExport(output_file, quantization, config.trigger_mode,
+                            config.max_triggers)
+        dsets = h5_file.dsets
+        statistics = h5_file
+    elif config.resume and os.path.exists(output_file):
+        h5_file = h5py.File(output_file, 'a')
+        dsets = open_datasets(h5_file)
+        output_format = h5_file.attrs["output_format"]
+        quantization = json.loads(h5_file.attrs.get("quantization", "null"))
+        trigger_mode = h5_file.attrs.get("trigger_mode", "first")
+        max_triggers = int(h5_file.attrs.get("max_triggers", 1)) or None
+        done, offset = read_progress(h5_file)
+        truncate_datasets(dsets, offset)
+        statistics = h5_file.get(STATISTICS)
+        if statistics is not None:
+            truncate_statistics(statistics, len(done))
+        else:
+            print("No statistics in {}, they are not collected".format(output_file))
+        # Skip converted files, counting repeated names in the file list
+        done = collections.Counter(done)
+        todo = []
+        for filename in files:
+            if done[filename] > 0:
+                done[filename] -= 1
+            else:
+                todo.append(filename)
+        print("Resuming after {} converted files at event {}, {} files left"
+              .format(len(files)-len(todo), offset, len(todo)))
+        instrumentation.num_files -= len(files) - len(todo)
+        files = todo
+    else:
+        num_nonzero_events = None
+        if config.prescan or STORAGE_PROFILES[config.storage_profile]["chunk_events"] is None:
+            with instrumentation.stage("prescan"):
+                num_nonzero_events, nonzero_file_events = count_events(
+                    files, trigger_mode, max_triggers)
+            print(num_nonzero_events)
+            expected_events = [len(indices) for indices in nonzero_file_events]
+        h5_file = h5py.File(output_file, 'w')
+        dsets = create_datasets(h5_file, num_nonzero_events, output_format,
+                                config.storage_profile, config.chunk_events,
+                                quantization, trigger_mode, max_triggers)
+        statistics = h5_file[STATISTICS]
+
+    # With a memory budget the files are reduced to hit lists, and the
+    # dense images are only built one block at a time, in one buffer
+    block_events = None
+    process_format = "dense" if output_format == "npy" else output_format
+    if config.max_memory is not None and "event_data" not in dsets:
+        print("Ignoring --max-memory: {} output is already written as hit lists"
+              .format(output_format))
+    elif config.max_memory is not None:
+        image_bytes = np.prod(dsets["event_data"].shape[1:])*dsets["event_data"].dtype.itemsize
+        block_events = max(1, int(config.max_memory*2**20 // image_bytes))
+        process_format = "sparse"
+    elif config.workers > 1 and "event_data" in dsets:
+        # Hit lists are a small fraction of the images to pass back
+        block_events = WORKER_BLOCK_EVENTS
+        process_format = "sparse"
+    block = None
+    if block_events is not None:
+        block = np.zeros((block_events,)+dsets["event_data"].shape[1:],
+                         dtype=dsets["event_data"].dtype)
+
+    max_errors = [h5_file.attrs.get("max_charge_error", 0.),
+                  h5_file.attrs.get("max_time_error", 0.)]
+    num_clipped = [int(h5_file.attrs.get("num_clipped_charges", 0)),
+                   int(h5_file.attrs.get("num_clipped_times", 0))]
+    pmt_to_pixel = load_pmt_lookup(PMT_LABELS, config.mapping_cache)
+    processed = iter_processed_files(files, pmt_to_pixel, config.workers,
+                                     process_format, quantization,
+                                     trigger_mode, max_triggers)
+    for file_index, (filename, events) in enumerate(processed):
+        if (expected_events is not None
+                and len(events["labels"]) != expected_events[file_index]):
+            raise ValueError("{} has {} events with hits in the kept triggers,"
+                             " the prescan counted {}".format(
+                                 filename, len(events["labels"]),
+                                 expected_events[file_index]))
+        timings = events["timings"]
+        start = time.perf_counter()
+        num_events = len(events["labels"])
+        offset = write_events(dsets, offset, events, block)
+        start = stage_done(timings, "write", start)
+        if output_format == "npy":
+            statistics.record_statistics(filename, events["statistics"])
+        elif statistics is not None:
+            record_statistics(statistics, filename, events["statistics"])
+        if quantization is not None:
+            max_errors = np.maximum(max_errors, events["quantization_error"])
+            h5_file.attrs["max_charge_error"], h5_file.attrs["max_time_error"] = max_errors
+            if any(events["quantization_clipped"]):
+                print("Warning: {} charges and {} times of {} are outside the {}"
+                      " range of the scales and offsets and were clipped".format(
+                          *events["quantization_clipped"], filename,
+                          quantization["dtype"]))
+                num_clipped = np.add(num_clipped, events["quantization_clipped"])
+                h5_file.attrs["num_clipped_charges"] = int(num_clipped[0])
+                h5_file.attrs["num_clipped_times"] = int(num_clipped[1])
+        if output_format == "npy":
+            h5_file.record_progress(filename, offset)
+        else:
+            record_progress(h5_file, filename, offset)
+        stage_done(timings, "record", start)
+        print("Finished file: {}".format(filename))
+        instrumentation.file_done(filename, num_events, timings,
+                                  written_bytes(dsets, events))
+
+    print(offset)
+    finalize_start = time.perf_counter()
+    if expected_events is not None and offset != num_nonzero_events:
+        raise ValueError("Converted {} events but the prescan counted {}".format(
+            offset, num_nonzero_events))
+    if statistics is not None:
+        total = statistics.write_statistics_total() if output_format == "npy" \
+            else write_statistics_total(statistics)
+        if total["num_events"] != offset:
+            raise ValueError("Statistics count {} events but {} were written".format(
+                total["num_events"], offset))
+        print_statistics(total)
+    if quantization is not None:
+        print("Maximum {} round-trip error: charge {:.4g} pe, time {:.4g} ns".format(
+            quantization["dtype"], *max_errors))
+        if any(num_clipped):
+            print("Warning: {} charges and {} times were clipped, adjust the"
+                  " scales and offsets to store them".format(*num_clipped))
+    split_settings = (config.split_fractions, config.split_seed,
+                      config.split_chunk_events)
+    if output_format == "npy":
+        h5_file.write_summary_orders()
+        labels = np.load(dsets["labels"].path, mmap_mode='r')
+        h5_file.write_splits(make_splits(labels, *split_settings), *split_settings)
+    else:
+        check_datasets(dsets, offset)
+        write_summary_orders(h5_file, {name: dsets[EVENT_SUMMARY+"/"+name][...]
+                                       for name in SUMMARY_COLUMNS})
+        write_splits(h5_file, make_splits(dsets["labels"][...], *split_settings),
+                     *split_settings)
+    print("Saving")
+    h5_file.close()
+    stage_done(instrumentation.timings, "finalize", finalize_start)
+    return offset
+
+def shard_file_name(output_file, shard_id):
+    """
+    Path of a shard of output_file: merged.h5 -> merged_0003.h5
+    """
+    stem, ext = os.path.splitext(output_file)
+    return "{}_{:04d}{}".format(stem, shard_id, ext or ".h5")
+
+def write_virtual_index(output_file, shard_files, split_settings=((0.8, 0.1, 0.1), 0, 1)):
+    """
+    Writes output_file with virtual datasets concatenating the datasets of
+    the shard files, so the shards can be read as one file. The shard paths
+    are stored relative to output_file. The per-shard indices, the
+    event_hits_offset of sparse shards and root_file_index, are written as
+    real datasets shifted for each shard, along with the joined root file
+    table and statistics. The splits of all the events are made with
+    split_settings, the fractions, seed and chunk_events of make_splits.
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    sources = [os.path.relpath(os.path.abspath(f), output_dir) for f in shard_files]
+    shards = [h5py.File(f, 'r') for f in shard_files]
+    try:
+        dsets = [open_datasets(shard) for shard in shards]
+        event_counts = np.array([len(d["labels"]) for d in dsets], dtype=np.int64)
+        with h5py.File(output_file, 'w') as h5_file:
+            for name, dset in dsets[0].items():
+                if name in ("event_hits_offset", "root_file_index", ROOT_FILE_TABLE):
+                    continue
+                lengths = [d[name].shape[0] for d in dsets]
+                layout = h5py.VirtualLayout(shape=(sum(lengths),)+dset.shape[1:],
+                                            dtype=dset.dtype)
+                start = 0
+                for source, length in zip(sources, lengths):
+                    if length > 0:
+                        layout[start:start+length] = h5py.VirtualSource(
+                            source, name, shape=(length,)+dset.shape[1:])
+                    start += length
+                h5_file.create_virtual_dataset(name, layout)
+                h5_file[name].attrs.update(dset.attrs)
+
+            if "event_hits_offset" in dsets[0]:
+                event_hits_offset = [np.zeros(1, dtype=np.int64)]
+                hit_offset = 0
+                for d in dsets:
+                    event_hits_offset.append(d["event_hits_offset"][1:] + hit_offset)
+                    hit_offset += d["event_hits_offset"][-1]
+                h5_file.create_dataset("event_hits_offset",
+                                       data=np.concatenate(event_hits_offset))
+
+            root_file_index = []
+            table_offset = 0
+            for d in dsets:
+                root_file_index.append(d["root_file_index"][...] + table_offset)
+                table_offset += d[ROOT_FILE_TABLE].shape[0]
+            h5_file.create_dataset("root_file_index",
+                                   data=np.concatenate(root_file_index).astype(np.int32))
+            h5_file.create_dataset(ROOT_FILE_TABLE,
+                                   data=[name for d in dsets
+                                         for name in d[ROOT_FILE_TABLE].asstr()[...]],
+                                   dtype=h5py.special_dtype(vlen=str))
+
+            h5_file.create_dataset("shard_files", data=sources,
+                                   dtype=h5py.special_dtype(vlen=str))
+            shard_offsets = np.zeros(len(shards)+1, dtype=np.int64)
+            np.cumsum(event_counts, out=shard_offsets[1:])
+            h5_file.create_dataset("shard_offsets", data=shard_offsets)
+            for key, value in shards[0].attrs.items():
+                h5_file.attrs[key] = value
+            for key in ("max_charge_error", "max_time_error"):
+                if key in h5_file.attrs:
+                    h5_file.attrs[key] = max(shard.attrs[key] for shard in shards)
+            for key in ("num_clipped_charges", "num_clipped_times"):
+                if any(key in shard.attrs for shard in shards):
+                    h5_file.attrs[key] = sum(int(shard.attrs.get(key, 0)) for shard in shards)
+
+            if all(STATISTICS in shard for shard in shards):
+                shard_statistics = [read_statistics(shard[STATISTICS]) for shard in shards]
+                rows = {name: np.concatenate([r[name] for _, r in shard_statistics])
+                        for name in FILE_STATISTICS}
+                create_statistics(h5_file, [f for files, _ in shard_statistics
+                                            for f in files], rows)
+                write_statistics_total(h5_file[STATISTICS])
+
+            write_summary_orders(h5_file, {
+                name: np.concatenate([d[EVENT_SUMMARY+"/"+name][...] for d in dsets])
+                for name in SUMMARY_COLUMNS})
+            labels = np.concatenate([d["labels"][...] for d in dsets])
+            write_splits(h5_file, make_splits(labels, *split_settings), *split_settings)
+    finally:
+        for shard in shards:
+            shard.close()
+    return int(event_counts.sum())
+
 if __name__ == '__main__':
     
 # -- Parse arguments
@@ -72,104 +1915,47 @@ if __name__ == '__main__':
     print("Merging "+str(len(files))+" files")
     
     # Start merging
-    num_nonzero_events, nonzero_event_indexes = count_events(files)
-    print(num_nonzero_events) 
-    dtype_events = np.dtype(np.float32)
-    dtype_labels = np.dtype(np.int32)
-    dtype_energies = np.dtype(np.float32)
-    dtype_positions = np.dtype(np.float32)
-    dtype_IDX = np.dtype(np.int32)
-    dtype_PATHS = h5py.special_dtype(vlen=str)
-    dtype_angles = np.dtype(np.float32)
-    h5_file = h5py.File(config.output_file[0], 'w')
-    dset_event_data = h5_file.create_dataset("event_data",
-                                       shape=(num_nonzero_events,)+IMAGE_SHAPE,
-                                       dtype=dtype_events)
-    dset_labels = h5_file.create_dataset("labels",
-                                   shape=(num_nonzero_events,),
-                                   dtype=dtype_labels)
-    dset_energies = h5_file.create_dataset("energies",
-                                     shape=(num_nonzero_events, 1),
-                                     dtype=dtype_energies)
-    dset_positions = h5_file.create_dataset("positions",
-                                      shape=(num_nonzero_events, 1, 3),
-                                      dtype=dtype_positions)
-    dset_IDX = h5_file.create_dataset("event_ids",
-                                shape=(num_nonzero_events,),
-                                dtype=dtype_IDX)
-    dset_PATHS = h5_file.create_dataset("root_files",
-                                  shape=(num_nonzero_events,),
-                                  dtype=dtype_PATHS)
-    dset_angles = h5_file.create_dataset("angles",
-                                 shape=(num_nonzero_events, 2),
-                                 dtype=dtype_angles)
-    
-    # 22 -> gamma, 11 -> electron, 13 -> muon
-    # corresponds to labelling used in CNN with only barrel
-    #IWCDmPMT_4pi_full_tank_gamma_E0to1000MeV_unif-pos-R371-y521cm_4pi-dir_3000evts_329.npz has an event with pid 11 though....
-    #pid_to_label = {22:0, 11:1, 13:2}
-    
-    offset = 0
-    offset_next = 0
-    mPMT_to_index = GenMapping(PMT_LABELS)
-    for file_index, filename in enumerate(files):
-        data = np.load(filename, allow_pickle=True)
-        nonzero_events_in_file = len(nonzero_event_indexes[file_index])
-        x_data = np.zeros((nonzero_events_in_file,)+IMAGE_SHAPE, 
-                          dtype=dtype_events)
-        digi_hit_pmt = data['digi_hit_pmt']
-        digi_hit_charge = data['digi_hit_charge']
-        digi_hit_time = data['digi_hit_time']
-        digi_hit_trigger = data['digi_hit_trigger']
-        trigger_time = data['trigger_time']
-        delay = 0
-        for i in range(len(digi_hit_pmt)):
-            first_trigger = np.argmin(trigger_time[i])
-            good_hits = np.where(digi_hit_trigger[i]==first_trigger)
-            hit_pmts = digi_hit_pmt[i][good_hits]
-            if len(hit_pmts) == 0:
-                delay += 1
-                continue
-            charge = digi_hit_charge[i][good_hits]
-            time = digi_hit_time[i][good_hits]
-            hit_mpmts = hit_pmts // 19
-            pmt_channels = hit_pmts % 19
-            rows = mPMT_to_index[hit_mpmts,0]
-            cols = mPMT_to_index[hit_mpmts,1]
-            x_data[i-delay, rows, cols, pmt_channels] = charge
-            x_data[i-delay, rows, cols, pmt_channels + 19] = time
-        
-        event_id = data['event_id']
-        root_file = data['root_file']
-        pid = data['pid']
-        position = data['position']
-        direction = data['direction']
-        energy = data['energy'] 
-        
-        offset_next += nonzero_events_in_file 
-        
-        file_indices = nonzero_event_indexes[file_index]
-
-        dset_IDX[offset:offset_next] = event_id[file_indices]
-        dset_PATHS[offset:offset_next] = root_file[file_indices]
-        dset_energies[offset:offset_next,:] = energy[file_indices].reshape(-1,1)
-        dset_positions[offset:offset_next,:,:] = position[file_indices].reshape(-1,1,3)
-        
-        labels = np.full(pid.shape[0], -1)
-        labels[pid==22] = 0
-        labels[pid==11] = 1
-        labels[pid==13] = 2
-        dset_labels[offset:offset_next] = labels[file_indices]
-
-        direction = direction[file_indices]
-        polar = np.arccos(direction[:,1])
-        azimuth = np.arctan2(direction[:,2], direction[:,0])
-        dset_angles[offset:offset_next,:] = np.hstack((polar.reshape(-1,1),azimuth.reshape(-1,1)))
-        dset_event_data[offset:offset_next,:] = x_data
-        
-        offset = offset_next
-        print("Finished file: {}".format(filename))
-        
-    print("Saving")
-    h5_file.close()
+    output_file = config.output_file[0]
+    if config.shard_size is not None and config.output_format == "npy":
+        raise ValueError("--shard-size is not supported for the npy format")
+    if config.shard_size is None and (config.shard_id is not None or config.index_only):
+        raise ValueError("--shard-id and --index-only need --shard-size")
+    if config.shard_id is not None and config.index_only:
+        raise ValueError("--index-only writes the index of all the shards,"
+                         " it can't be used with --shard-id")
+    instrumentation = Instrumentation(len(files), config.profile, config.profile_json)
+    profiler = None
+    if config.cprofile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if config.shard_size is None:
+        convert(files, output_file, config, instrumentation)
+    else:
+        shards = [files[i:i+config.shard_size]
+                  for i in range(0, len(files), config.shard_size)]
+        shard_files = [shard_file_name(output_file, i) for i in range(len(shards))]
+        if config.shard_id is not None and not 0 <= config.shard_id < len(shards):
+            raise ValueError("--shard-id {} is out of range, {} files make {} shards"
+                             .format(config.shard_id, len(files), len(shards)))
+        shard_ids = range(len(shards)) if config.shard_id is None else [config.shard_id]
+        instrumentation.num_files = 0 if config.index_only else sum(
+            len(shards[shard_id]) for shard_id in shard_ids)
+        if not config.index_only:
+            for shard_id in shard_ids:
+                print("Writing shard {} of {}: {}".format(
+                    shard_id+1, len(shards), shard_files[shard_id]))
+                convert(shards[shard_id], shard_files[shard_id], config,
+                        instrumentation)
+        if config.shard_id is None:
+            with instrumentation.stage("finalize"):
+                num_events = write_virtual_index(output_file, shard_files,
+                                                 (config.split_fractions, config.split_seed,
+                                                  config.split_chunk_events))
+            print("Wrote index of {} shards, {} events".format(len(shards), num_events))
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(config.cprofile)
+        print("Wrote cProfile stats to {}, the slowest calls:".format(config.cprofile))
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+    instrumentation.close()
     print("Finished")
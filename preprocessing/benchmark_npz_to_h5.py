@@ -0,0 +1,395 @@
+"""
+Benchmarks for the npz -> h5 converter in CNN_endcaps_npz_to_h5.py.
+
+Usage:
+  python benchmark_npz_to_h5.py builder file1.npz [file2.npz ...]
+  python benchmark_npz_to_h5.py profiles file1.npz [file2.npz ...]
+  python benchmark_npz_to_h5.py reader merged.h5|npy_export_dir
+  python benchmark_npz_to_h5.py pipeline [file1.npz ...] [--synthetic-files 4]
+
+Without input files the pipeline benchmark converts synthetic files
+written by synthetic_npz.py.
+"""
+import os
+import sys
+import json
+import time
+import h5py
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+from CNN_endcaps_npz_to_h5 import (IMAGE_SHAPE, PMT_LABELS,
+                                   STORAGE_PROFILES, GenMapping, hdf5plugin,
+                                   load_pmt_lookup, maxrss_bytes,
+                                   build_event_images, create_datasets,
+                                   process_file, write_events)
+from synthetic_npz import write_synthetic_files
+from endcaps_h5_reader import (BatchPrefetcher, ChunkLocalSampler,
+                               EndcapsH5Dataset, NpyExportDataset,
+                               read_event_data)
+
+# Converter options of each mode of the pipeline benchmark
+PIPELINE_MODES = {
+    "dense": [],
+    "sparse": ["--format", "sparse"],
+    "npy": ["--format", "npy"],
+    "dense-uint16": ["--event-dtype", "uint16"],
+    "sparse-float16": ["--format", "sparse", "--event-dtype", "float16"],
+    "max-memory": ["--max-memory", "64"],
+    "separate-triggers": ["--trigger-mode", "separate"],
+    "trigger-channels": ["--trigger-mode", "channels"],
+}
+CONVERTER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "CNN_endcaps_npz_to_h5.py")
+
+def build_event_images_loop(digi_hit_pmt, digi_hit_charge, digi_hit_time,
+                            digi_hit_trigger, trigger_time, mPMT_to_index):
+    """
+    Per-event reference implementation of build_event_images
+    (the loop the converter used before it was vectorized).
+    """
+    x_data = np.zeros((len(digi_hit_pmt),)+IMAGE_SHAPE, dtype=np.float32)
+    file_indices = []
+    for i in range(len(digi_hit_pmt)):
+        first_trigger = np.argmin(trigger_time[i])
+        good_hits = np.where(digi_hit_trigger[i]==first_trigger)
+        hit_pmts = digi_hit_pmt[i][good_hits]
+        if len(hit_pmts) == 0:
+            continue
+        charge = digi_hit_charge[i][good_hits]
+        time = digi_hit_time[i][good_hits]
+        hit_mpmts = hit_pmts // 19
+        pmt_channels = hit_pmts % 19
+        rows = mPMT_to_index[hit_mpmts,0]
+        cols = mPMT_to_index[hit_mpmts,1]
+        x_data[len(file_indices), rows, cols, pmt_channels] = charge
+        x_data[len(file_indices), rows, cols, pmt_channels + 19] = time
+        file_indices.append(i)
+    return x_data[:len(file_indices)], np.array(file_indices, dtype=np.int64)
+
+def best_time(function, args, repeat):
+    """
+    Returns the result of function(*args) and the best wall time of repeat calls.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+def benchmark_builder(config):
+    """
+    Compares the vectorized image builder with the per-event loop.
+    """
+    mPMT_to_index = GenMapping(PMT_LABELS)
+    pmt_to_pixel = load_pmt_lookup(PMT_LABELS)
+    total_loop = total_vectorized = 0.
+    total_events = 0
+    for filename in config.files:
+        data = np.load(filename, allow_pickle=True)
+        args = tuple(data[key] for key in ('digi_hit_pmt', 'digi_hit_charge',
+                                           'digi_hit_time', 'digi_hit_trigger',
+                                           'trigger_time'))
+        (loop_images, loop_indices), loop_time = best_time(
+            build_event_images_loop, args + (mPMT_to_index,), config.repeat)
+        (images, indices), vectorized_time = best_time(
+            build_event_images, args + (pmt_to_pixel,), config.repeat)
+        if not (np.array_equal(indices, loop_indices)
+                and np.array_equal(images, loop_images)):
+            raise RuntimeError("Vectorized and loop images differ for "+filename)
+        num_events = len(args[0])
+        print("{}: {} events, loop {:.3f} s, vectorized {:.3f} s, speedup {:.1f}x"
+              .format(filename, num_events, loop_time, vectorized_time,
+                      loop_time/vectorized_time))
+        total_loop += loop_time
+        total_vectorized += vectorized_time
+        total_events += num_events
+    print("Total: loop {:.0f} events/s, vectorized {:.0f} events/s"
+          .format(total_events/total_loop, total_events/total_vectorized))
+
+def benchmark_profiles(config):
+    """
+    Writes the same events with each storage profile and reports the write
+    throughput, the file size and the latency of random event reads.
+    """
+    pmt_to_pixel = load_pmt_lookup(PMT_LABELS)
+    events = [process_file(f, pmt_to_pixel, config.output_format)
+              for f in config.files]
+    num_events = sum(len(e["labels"]) for e in events)
+    data_keys = ("event_data",) if config.output_format == "dense" else (
+        "hit_index", "hit_charge", "hit_time")
+    data_bytes = sum(e[k].nbytes for e in events for k in data_keys)
+    print("{} events, {:.1f} MB of {} event data".format(
+        num_events, data_bytes/1e6, config.output_format))
+    print("{:>12} {:>10} {:>10} {:>10} {:>12} {:>14}".format(
+        "profile", "events/s", "MB/s", "size MB", "event ms",
+        "batch{} ms".format(config.batch_size)))
+
+    rng = np.random.default_rng(config.seed)
+    with tempfile.TemporaryDirectory(dir=config.output_dir) as tmpdir:
+        for profile in config.profiles:
+            if STORAGE_PROFILES[profile].get("compression") == "lz4" and hdf5plugin is None:
+                print("{:>12} skipped, hdf5plugin is not installed".format(profile))
+                continue
+            path = os.path.join(tmpdir, profile+".h5")
+            contiguous = STORAGE_PROFILES[profile]["chunk_events"] is None
+            start = time.perf_counter()
+            with h5py.File(path, 'w') as h5_file:
+                dsets = create_datasets(h5_file,
+                                        num_events if contiguous else None,
+                                        config.output_format, profile)
+                offset = 0
+                for file_events in events:
+                    offset = write_events(dsets, offset, file_events)
+            write_time = time.perf_counter() - start
+            size = os.path.getsize(path)
+
+            with h5py.File(path, 'r') as h5_file:
+                indices = rng.integers(num_events, size=config.reads)
+                start = time.perf_counter()
+                for i in indices:
+                    read_event_data(h5_file, i, i+1)
+                event_time = (time.perf_counter() - start)/config.reads
+
+                num_batches = max(1, config.reads//config.batch_size)
+                start = time.perf_counter()
+                for _ in range(num_batches):
+                    batch = np.sort(rng.choice(num_events, config.batch_size,
+                                               replace=False))
+                    for i in batch:
+                        read_event_data(h5_file, i, i+1)
+                batch_time = (time.perf_counter() - start)/num_batches
+
+            print("{:>12} {:>10.0f} {:>10.1f} {:>10.1f} {:>12.3f} {:>14.2f}".format(
+                profile, num_events/write_time, data_bytes/write_time/1e6,
+                size/1e6, event_time*1e3, batch_time*1e3))
+
+def benchmark_reader(config):
+    """
+    Reports the events/s of EndcapsH5Dataset (or NpyExportDataset for an
+    npy export directory) for sequential and random sampling, compared with
+    reading random events one at a time.
+    """
+    if os.path.isdir(config.file):
+        dataset = NpyExportDataset(config.file)
+    else:
+        dataset = EndcapsH5Dataset(config.file)
+    num_events = len(dataset)
+    batch_size = min(config.batch_size, num_events)
+    num_batches = config.batches
+    rng = np.random.default_rng(config.seed)
+    chunk_events = config.chunk_events or max(dataset.chunk_events, batch_size)
+    sampler = ChunkLocalSampler(np.arange(num_events), batch_size, chunk_events,
+                                seed=config.seed, drop_last=True)
+
+    def sequential():
+        for b in range(num_batches):
+            start = (b*batch_size) % (num_events - batch_size + 1)
+            yield np.arange(start, start+batch_size)
+
+    def random():
+        for _ in range(num_batches):
+            yield rng.choice(num_events, batch_size, replace=False)
+
+    def chunk_local():
+        epoch = 0
+        while True:
+            sampler.set_epoch(epoch)
+            for batch in sampler:
+                yield batch
+            epoch += 1
+
+    def one_at_a_time(batches):
+        for batch in batches:
+            # Copy the rows, mapped arrays would otherwise not be read
+            yield [{key: np.array(rows) for key, rows in dataset[int(i)].items()}
+                   for i in batch]
+
+    def batched(batches):
+        for batch in batches:
+            yield dataset.get_batch(batch)
+
+    def limited(batches):
+        for _, batch in zip(range(num_batches), batches):
+            yield batch
+
+    runs = (
+        ("sequential, batched", lambda: batched(sequential())),
+        ("random, one event at a time", lambda: one_at_a_time(random())),
+        ("random, batched", lambda: batched(random())),
+        ("chunk-local, batched", lambda: batched(limited(chunk_local()))),
+        ("chunk-local, prefetched", lambda: BatchPrefetcher(
+            dataset, list(limited(chunk_local())), config.prefetch)),
+    )
+    print("{} events, batches of {}, chunk-local windows of {} events".format(
+        num_events, batch_size, chunk_events))
+    for name, run in runs:
+        start = time.perf_counter()
+        num = 0
+        for _ in run():
+            num += batch_size
+        print("{:>30}: {:10.0f} events/s".format(name, num/(time.perf_counter()-start)))
+
+def output_size(path):
+    """
+    Size in bytes of an output file or of the files of an npy export.
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+def run_converter(args, profile_json):
+    """
+    Runs the converter with args in a subprocess, with the profile of its
+    Instrumentation written to profile_json. Returns its wall time, peak
+    resident memory in bytes, which doesn't count --workers processes, and
+    the summary record of the profile (events, output bytes and the time
+    of each stage).
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, CONVERTER] + args
+                               + ["--profile-json", profile_json],
+                               cwd=os.path.dirname(CONVERTER),
+                               stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    with open(profile_json) as f:
+        records = [json.loads(line) for line in f]
+    summary = [record for record in records if record["type"] == "summary"][-1]
+    return wall_time, maxrss_bytes(usage.ru_maxrss), summary
+
+def pipeline_args(mode, config):
+    """
+    Converter options of a pipeline benchmark mode.
+    """
+    return PIPELINE_MODES[mode] + config.converter_args.split()
+
+def benchmark_pipeline(config):
+    """
+    Converts the same npz files with each mode of PIPELINE_MODES, running
+    the converter in its own process. Reports events/s, MB/s of output
+    written, peak resident memory and the time of the stages timed by the
+    converter's Instrumentation: loading the npz arrays (the prescan, load
+    and metadata stages), mapping the hits to events (select and build),
+    writing the events with their statistics and progress (write and
+    record) and the end of the conversion (statistics, selection index
+    and splits).
+    """
+    with tempfile.TemporaryDirectory(dir=config.output_dir) as tmpdir:
+        files = config.files
+        if not files:
+            files = write_synthetic_files(os.path.join(tmpdir, "npz"),
+                                          config.synthetic_files,
+                                          config.synthetic_events, config.seed)
+        file_list = os.path.join(tmpdir, "file_list.txt")
+        with open(file_list, "w") as f:
+            f.writelines(os.path.abspath(path)+"\n" for path in files)
+        input_bytes = sum(os.path.getsize(path) for path in files)
+        print("{} files, {:.1f} MB of npz".format(len(files), input_bytes/1e6))
+        print("{:>18} {:>8} {:>10} {:>8} {:>9} {:>9} {:>8} {:>8} {:>8} {:>8}".format(
+            "mode", "events", "events/s", "MB/s", "size MB", "RSS MB",
+            "load s", "map s", "write s", "final s"))
+        for mode in config.modes:
+            output = os.path.join(tmpdir, mode if "npy" in mode else mode+".h5")
+            wall_time, peak_rss, summary = run_converter(
+                pipeline_args(mode, config) + [file_list, output],
+                os.path.join(tmpdir, mode+".json"))
+            size = output_size(output)
+            shutil.rmtree(output) if os.path.isdir(output) else os.remove(output)
+            stages = summary["stages"]
+            load_time, map_time, write_time = (
+                sum(stages.get(stage, 0.) for stage in group) for group in (
+                    ("prescan", "load", "metadata"), ("select", "build"),
+                    ("write", "record")))
+            num_events = summary["events"]
+            print(("{:>18} {:>8} {:>10.0f} {:>8.1f} {:>9.1f} {:>9.1f}"
+                   " {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}").format(
+                       mode, num_events, num_events/wall_time, size/wall_time/1e6,
+                       size/1e6, peak_rss/2**20, load_time, map_time, write_time,
+                       stages.get("finalize", 0.)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the npz to hdf5 converter")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    builder = subparsers.add_parser("builder",
+        help="Compare the vectorized event image builder with the per-event loop")
+    builder.add_argument("files", type=str, nargs="+",
+                         help="Input npz files.")
+    builder.add_argument("--repeat", type=int, default=3,
+                         help="Number of timed runs, the best one is reported.")
+    builder.set_defaults(run=benchmark_builder)
+
+    profiles = subparsers.add_parser("profiles",
+        help="Compare the storage profiles of the h5 datasets")
+    profiles.add_argument("files", type=str, nargs="+",
+                          help="Input npz files.")
+    profiles.add_argument("--profiles", type=str, nargs="+",
+                          default=sorted(STORAGE_PROFILES),
+                          choices=sorted(STORAGE_PROFILES),
+                          help="Storage profiles to compare.")
+    profiles.add_argument("--format", type=str, default="dense",
+                          choices=("dense", "sparse"), dest="output_format",
+                          help="Output format of the converter.")
+    profiles.add_argument("--reads", type=int, default=1000,
+                          help="Number of random event reads.")
+    profiles.add_argument("--batch-size", type=int, default=32,
+                          help="Events per random minibatch.")
+    profiles.add_argument("--seed", type=int, default=0,
+                          help="Seed of the random event indices.")
+    profiles.add_argument("--output-dir", type=str, default=None,
+                          help="Directory for the temporary h5 files.")
+    profiles.set_defaults(run=benchmark_profiles)
+
+    reader = subparsers.add_parser("reader",
+        help="Measure the read throughput of EndcapsH5Dataset")
+    reader.add_argument("file", type=str,
+                        help="h5 file or npy export directory written by\
+                        the converter.")
+    reader.add_argument("--batch-size", type=int, default=64,
+                        help="Events per batch.")
+    reader.add_argument("--batches", type=int, default=50,
+                        help="Number of batches read in each run.")
+    reader.add_argument("--chunk-events", type=int, default=None,
+                        help="Events per locality block of the chunk-local\
+                        sampler (default: the larger of the chunk size and\
+                        the batch size).")
+    reader.add_argument("--prefetch", type=int, default=2,
+                        help="Batches read ahead by the prefetch thread.")
+    reader.add_argument("--seed", type=int, default=0,
+                        help="Seed of the random batches.")
+    reader.set_defaults(run=benchmark_reader)
+
+    pipeline = subparsers.add_parser("pipeline",
+        help="Measure the converter in each output mode")
+    pipeline.add_argument("files", type=str, nargs="*",
+                          help="Input npz files (default: synthetic files).")
+    pipeline.add_argument("--modes", type=str, nargs="+",
+                          default=list(PIPELINE_MODES), choices=list(PIPELINE_MODES),
+                          help="Converter modes to run.")
+    pipeline.add_argument("--converter-args", type=str, default="",
+                          help="Options added to the converter command line\
+                          of every mode, e.g. \"--workers 4\".")
+    pipeline.add_argument("--synthetic-files", type=int, default=4,
+                          help="Number of synthetic files without input files.")
+    pipeline.add_argument("--synthetic-events", type=int, default=3000,
+                          help="Events per synthetic file.")
+    pipeline.add_argument("--seed", type=int, default=0,
+                          help="Seed of the synthetic files.")
+    pipeline.add_argument("--output-dir", type=str, default=None,
+                          help="Directory for the temporary files.")
+    pipeline.set_defaults(run=benchmark_pipeline)
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    config = parse_args()
+    config.run(config)
@@ -0,0 +1,261 @@
+"""
+Functions reading the h5 files written by CNN_endcaps_npz_to_h5.py with
+only h5py and numpy, and EventSelection. They are used by the datasets of
+endcaps_h5_reader.py, which re-exports them, and by tools that have to
+open a file quickly, like the event display, without importing torch.
+"""
+import os
+import h5py
+import json
+import numpy as np
+
+try:
+    # Registers the filters needed to read files written with the lz4 profile
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+from CNN_endcaps_npz_to_h5 import (IMAGE_SHAPE, dequantize,
+                                   dequantize_event_data, expand_hits)
+
+def is_sparse(h5_file):
+    """
+    Returns whether the file holds hit lists instead of dense event_data.
+    """
+    return "event_hits_offset" in h5_file
+
+def num_events(h5_file):
+    """
+    Number of events in the file.
+    """
+    return len(h5_file["labels"])
+
+def read_root_files(h5_file, start=0, stop=None):
+    """
+    Returns the root file path of events [start, stop) as an array of str.
+    Works with files storing root_file_index into root_file_table and with
+    older files storing the path of every event in root_files.
+    """
+    if "root_file_index" not in h5_file:
+        return h5_file["root_files"].asstr()[start:stop]
+    table = np.asarray(h5_file["root_file_table"].asstr()[...], dtype=object)
+    return table[h5_file["root_file_index"][start:stop]]
+
+def read_hits(dset, first, last, hits=slice(None)):
+    """
+    Reads hits [first, last) of hit_charge or hit_time as float32,
+    keeping the ones selected by hits.
+    """
+    values = dset[first:last][hits]
+    return dequantize(values, dset.attrs.get("scale", 1.), dset.attrs.get("offset", 0.))
+
+def normalization(total, pixels="all"):
+    """
+    Returns the mean, std, min and max of each image channel from the total
+    statistics written by the converter, over all the pixels of the images
+    or over the pixels with a hit (pixels="hit").
+    """
+    prefix = {"all": "pixel_", "hit": "hit_"}[pixels]
+    return {name: np.asarray(total[prefix+name]) for name in ("mean", "std", "min", "max")}
+
+def read_normalization(h5_file, pixels="all"):
+    """
+    Returns the normalization of a file (see normalization).
+    """
+    total = h5_file["statistics/total"]
+    return normalization({name: dset[...] for name, dset in total.items()}, pixels)
+
+def read_sparse_events(h5_file, start, stop):
+    """
+    Reads the hit lists of events [start, stop) of a sparse file and
+    expands them into dense images.
+    """
+    event_hits_offset = h5_file["event_hits_offset"][start:stop+1]
+    first, last = event_hits_offset[0], event_hits_offset[-1]
+    return expand_hits(event_hits_offset - first,
+                       h5_file["hit_index"][first:last],
+                       read_hits(h5_file["hit_charge"], first, last),
+                       read_hits(h5_file["hit_time"], first, last),
+                       h5_file.attrs.get("image_shape", IMAGE_SHAPE))
+
+def read_event_data(h5_file, start=0, stop=None):
+    """
+    Returns the dense images of events [start, stop) of a dense or sparse file.
+    """
+    start, stop, _ = slice(start, stop).indices(num_events(h5_file))
+    stop = max(start, stop)
+    if is_sparse(h5_file):
+        return read_sparse_events(h5_file, start, stop)
+    dset = h5_file["event_data"]
+    return dequantize_event_data(dset[start:stop], dset.attrs)
+
+def index_runs(indices, max_gap=1):
+    """
+    Splits sorted unique indices into runs [start, stop) that are read with
+    one slice each. Indices less than max_gap apart share a run.
+    """
+    if len(indices) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(indices) > max_gap) + 1
+    starts = indices[np.r_[0, breaks]]
+    stops = indices[np.r_[breaks, len(indices)] - 1] + 1
+    return list(zip(starts, stops))
+
+def read_rows(dset, indices):
+    """
+    Reads the rows of dset at sorted unique indices, with one slice per run
+    of indices that fall in the same or neighbouring chunks.
+    """
+    max_gap = dset.chunks[0] if dset.chunks else 1
+    out = np.empty((len(indices),)+dset.shape[1:], dtype=dset.dtype)
+    pos = 0
+    for start, stop in index_runs(indices, max_gap):
+        num = np.searchsorted(indices, stop) - pos
+        if num == stop - start:
+            dset.read_direct(out, np.s_[start:stop], np.s_[pos:pos+num])
+        else:
+            out[pos:pos+num] = dset[start:stop][indices[pos:pos+num] - start]
+        pos += num
+    return out
+
+def read_sparse_rows(h5_file, event_hits_offset, indices):
+    """
+    Reads the hit lists of the events at sorted unique indices of a sparse
+    file and expands them into dense images. event_hits_offset is the whole
+    event_hits_offset dataset, which readers keep in memory. Events whose
+    hits are in the same or neighbouring chunks are read with one slice.
+    """
+    image_shape = tuple(h5_file.attrs.get("image_shape", IMAGE_SHAPE))
+    dset_index = h5_file["hit_index"]
+    out = np.zeros((len(indices),)+image_shape, dtype=np.float32)
+    hit_starts = event_hits_offset[indices]
+    hit_stops = event_hits_offset[indices+1]
+    max_gap = dset_index.chunks[0] if dset_index.chunks else 1
+    breaks = np.flatnonzero(hit_starts[1:] - hit_stops[:-1] > max_gap) + 1
+    for first_row, last_row in zip(np.r_[0, breaks], np.r_[breaks, len(indices)]):
+        first, last = hit_starts[first_row], hit_stops[last_row-1]
+        lengths = hit_stops[first_row:last_row] - hit_starts[first_row:last_row]
+        offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position in the slice of each hit of the selected events
+        hits = (np.repeat(hit_starts[first_row:last_row] - first - offsets[:-1], lengths)
+                + np.arange(offsets[-1]))
+        expand_hits(offsets, dset_index[first:last][hits],
+                    read_hits(h5_file["hit_charge"], first, last, hits),
+                    read_hits(h5_file["hit_time"], first, last, hits),
+                    image_shape, out[first_row:last_row])
+    return out
+
+def _cut_value(dtype, value, exact=False):
+    """
+    Converts a cut value to dtype, so the column is not converted to the
+    type of the value for every comparison. Values of integer columns are
+    rounded up, which keeps value >= low and value < high; with exact, a
+    value that is not an integer selects nothing and None is returned.
+    """
+    if dtype.kind in "iu":
+        if exact and value != np.ceil(value):
+            return None
+        value = np.ceil(value)
+    return dtype.type(value)
+
+class EventSelection:
+    """
+    Selects events by cuts on the event_summary columns written by the
+    converter (energy, x, y, z, radius, polar, azimuth, nhits,
+    total_charge, label) without reading the event data:
+
+        selection = EventSelection("merged.h5")
+        indices = selection.select(energy=(100, 500), label=1, radius=(None, 300))
+
+    A cut is either a (low, high) pair selecting low <= value < high, with
+    None for an open end, or a single value selecting value == cut. The
+    events in the range of the most selective cut are found by a binary
+    search in the sorted order of its column, and only those events are
+    checked against the other cuts. Columns and orders are loaded on first
+    use and kept in memory. path is an h5 file or an npy export directory.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._columns = {}
+        self._orders = {}
+        self._sorted = {}
+
+    def _load(self, name):
+        if os.path.isdir(self.path):
+            with open(os.path.join(self.path, "manifest.json")) as f:
+                info = json.load(f)["arrays"]["event_summary/"+name]
+            column = np.load(os.path.join(self.path, info["file"]))
+            with np.load(os.path.join(self.path, "event_summary_orders.npz")) as orders:
+                order = orders[name]
+        else:
+            with h5py.File(self.path, "r") as h5_file:
+                column = h5_file["event_summary"][name][...]
+                order = h5_file["event_summary"]["order_"+name][...]
+        self._columns[name] = column
+        self._orders[name] = order
+        self._sorted[name] = column[order]
+
+    def column(self, name):
+        """
+        Returns the event_summary column name of all events.
+        """
+        if name not in self._columns:
+            self._load(name)
+        return self._columns[name]
+
+    def _bounds(self, name, cut):
+        """
+        Returns the low and high value of cut and the range of positions
+        of the selected events in the sorted column.
+        """
+        self.column(name)
+        values = self._sorted[name]
+        if np.ndim(cut) == 0:
+            low = high = _cut_value(values.dtype, cut, exact=True)
+        else:
+            low, high = (None if v is None else _cut_value(values.dtype, v)
+                         for v in cut)
+        if np.ndim(cut) == 0 and low is None:
+            return low, high, 0, 0
+        first = 0 if low is None else np.searchsorted(values, low, side="left")
+        if np.ndim(cut) == 0:
+            last = np.searchsorted(values, high, side="right")
+        else:
+            last = len(values) if high is None else np.searchsorted(values, high, side="left")
+        return low, high, first, max(first, last)
+
+    def select(self, **cuts):
+        """
+        Returns the sorted indices of the events passing all cuts.
+        """
+        if not cuts:
+            raise ValueError("No cuts given")
+        bounds = {name: self._bounds(name, cut) for name, cut in cuts.items()}
+        best = min(bounds, key=lambda name: bounds[name][3] - bounds[name][2])
+        first, last = bounds[best][2:]
+        indices = np.sort(self._orders[best][first:last])
+        for name, (low, high, _, _) in bounds.items():
+            if name == best or len(indices) == 0:
+                continue
+            values = self._columns[name][indices]
+            if np.ndim(cuts[name]) == 0:
+                keep = values == low
+            else:
+                keep = np.ones(len(values), dtype=bool)
+                if low is not None:
+                    keep &= values >= low
+                if high is not None:
+                    keep &= values < high
+            indices = indices[keep]
+        return indices
+
+    def count(self, **cuts):
+        """
+        Returns the number of events passing all cuts.
+        """
+        if len(cuts) == 1:
+            (name, cut), = cuts.items()
+            _, _, first, last = self._bounds(name, cut)
+            return int(last - first)
+        return len(self.select(**cuts))
@@ -0,0 +1,306 @@
+"""
+Readers for the h5 files written by CNN_endcaps_npz_to_h5.py.
+
+Files written with --format sparse have no event_data dataset, the images
+are expanded from the hit lists on demand:
+
+    with h5py.File("merged.h5", "r") as f:
+        images = read_event_data(f, 0, 100)
+
+For training, EndcapsH5Dataset reads batches of events with one slice per
+run of nearby events, and ChunkLocalSampler shuffles events so that every
+batch only touches a few chunks:
+
+    dataset = EndcapsH5Dataset("merged.h5")
+    sampler = ChunkLocalSampler(dataset.indices("train_idxs"), 256, 64, seed=0)
+    for batch in BatchPrefetcher(dataset, sampler):
+        images, labels = batch["event_data"], batch["labels"]
+
+With PyTorch, use DataLoader(dataset, sampler=sampler, batch_size=None).
+
+Directories written with --format npy are read with NpyExportDataset, which
+has the same interface and hands out zero-copy slices of memory-mapped arrays.
+
+Charges and times stored as float16 or uint16 (--event-dtype) are returned
+as float32 by all the readers.
+
+The per-channel mean and standard deviation computed by the converter are
+read with read_normalization (or NpyExportDataset.normalization):
+
+    with h5py.File("merged.h5", "r") as f:
+        norm = read_normalization(f)
+    images = (images - norm["mean"])/norm["std"]
+
+EventSelection finds the events passing cuts on the per-event summary
+(energy, vertex, direction, number of hits, total charge, label) without
+reading the event data:
+
+    indices = EventSelection("merged.h5").select(energy=(100, 500), label=1)
+
+The functions that only need h5py and numpy, and EventSelection, are
+defined in endcaps_h5_io.py, which can be imported without torch.
+"""
+import os
+import h5py
+import json
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+
+try:
+    # Registers the filters needed to read files written with the lz4 profile
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+try:
+    from torch.utils.data import Dataset as _DatasetBase
+except ImportError:
+    _DatasetBase = object
+
+from CNN_endcaps_npz_to_h5 import dequantize_event_data
+from endcaps_h5_io import (is_sparse, num_events, read_root_files, read_hits,
+                           normalization, read_normalization, read_sparse_events,
+                           read_event_data, index_runs, read_rows,
+                           read_sparse_rows, EventSelection)
+
+DEFAULT_KEYS = ("event_data", "labels", "energies", "positions", "angles")
+
+class EndcapsH5Dataset(_DatasetBase):
+    """
+    Map-style dataset over a file written by CNN_endcaps_npz_to_h5.py, in
+    the style of a PyTorch Dataset (and a subclass of it when torch is
+    installed). Indexing with an int returns a dictionary with one event and
+    indexing with a sequence of ints returns a batch of events, read in
+    sorted order with one slice per run of nearby events. keys are the
+    datasets to read; event_data of sparse files is expanded to dense images.
+
+    The file is opened on first use in every process, so the dataset can be
+    passed to forked or spawned DataLoader workers.
+    """
+    def __init__(self, path, keys=DEFAULT_KEYS, rdcc_nbytes=64*2**20):
+        self.path = path
+        self.keys = tuple(keys)
+        self.rdcc_nbytes = rdcc_nbytes
+        self._file = None
+        self._pid = None
+        self._event_hits_offset = None
+        self._lock = threading.Lock()
+        with h5py.File(path, 'r') as h5_file:
+            self.length = num_events(h5_file)
+            self.sparse = is_sparse(h5_file)
+            chunks = None if self.sparse else h5_file["event_data"].chunks
+            self.chunk_events = chunks[0] if chunks else 1
+            self.event_data_attrs = {} if self.sparse else dict(h5_file["event_data"].attrs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_file=None, _pid=None, _event_hits_offset=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def h5_file(self):
+        """
+        The file handle of the current process.
+        """
+        with self._lock:
+            if self._file is None or self._pid != os.getpid():
+                # Handles inherited through fork can't be used by the child
+                self._file = h5py.File(self.path, 'r', rdcc_nbytes=self.rdcc_nbytes)
+                self._pid = os.getpid()
+                self._event_hits_offset = None
+                if self.sparse:
+                    self._event_hits_offset = self._file["event_hits_offset"][...]
+            return self._file
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if np.ndim(index) == 0:
+            return {key: rows[0] for key, rows in self.get_batch([index]).items()}
+        return self.get_batch(index)
+
+    def indices(self, name):
+        """
+        Returns an index dataset written by the converter: train_idxs,
+        val_idxs, test_idxs or the events of a label, such as gamma_idxs.
+        """
+        return self.h5_file[name][...]
+
+    def get_batch(self, indices):
+        """
+        Returns a dictionary with the keys datasets of the events at indices,
+        in the order of indices.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + self.length, indices)
+        unique, inverse = np.unique(indices, return_inverse=True)
+        in_order = len(unique) == len(indices) and np.array_equal(unique, indices)
+        h5_file = self.h5_file
+        batch = {}
+        for key in self.keys:
+            if key == "event_data" and self.sparse:
+                rows = read_sparse_rows(h5_file, self._event_hits_offset, unique)
+            elif key == "event_data":
+                rows = dequantize_event_data(read_rows(h5_file[key], unique),
+                                             self.event_data_attrs)
+            else:
+                rows = read_rows(h5_file[key], unique)
+            batch[key] = rows if in_order else rows[inverse]
+        return batch
+
+class ChunkLocalSampler:
+    """
+    Batch sampler that shuffles events while keeping every batch in a few
+    chunks. The chunks holding the indices are shuffled and grouped in
+    windows of window_chunks chunks; the events of each window are shuffled
+    and the windows are split into batches of batch_size. Each index is
+    yielded once per epoch. Call set_epoch to get a new order each epoch.
+    """
+    def __init__(self, indices, batch_size, chunk_events, window_chunks=4,
+                 seed=None, drop_last=False):
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.batch_size = batch_size
+        self.chunk_events = max(1, chunk_events)
+        self.window_chunks = window_chunks
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        return -(-len(self.indices) // self.batch_size)
+
+    def __iter__(self):
+        rng = np.random.default_rng(None if self.seed is None else (self.seed, self.epoch))
+        chunks, chunk_of_event = np.unique(self.indices // self.chunk_events,
+                                           return_inverse=True)
+        window = rng.permutation(len(chunks))[chunk_of_event] // self.window_chunks
+        order = self.indices[np.lexsort((rng.random(len(self.indices)), window))]
+        for batch in range(len(self)):
+            yield order[batch*self.batch_size:(batch+1)*self.batch_size]
+
+class BatchPrefetcher:
+    """
+    Iterates over dataset.get_batch(batch) for the batches of indices,
+    reading up to depth batches ahead in a background thread so that reading
+    overlaps with the work done on the previous batches.
+    """
+    def __init__(self, dataset, batches, depth=2):
+        self.dataset = dataset
+        self.batches = batches
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            pending = collections.deque()
+            for batch in self.batches:
+                pending.append(pool.submit(self.dataset.get_batch, batch))
+                if len(pending) > self.depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+class NpyExportDataset(_DatasetBase):
+    """
+    Dataset over a directory written by CNN_endcaps_npz_to_h5.py with
+    --format npy, with the same interface as EndcapsH5Dataset. The arrays
+    are opened with np.load(mmap_mode='r') on first use in every process.
+    Indexing with an int or a slice returns zero-copy views of the mapped
+    files, except for quantized event_data which is converted to float32;
+    batches of indices are gathered in sorted order.
+    """
+    def __init__(self, directory, keys=DEFAULT_KEYS):
+        self.directory = directory
+        self.keys = tuple(keys)
+        with open(os.path.join(directory, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.length = self.manifest["num_events"]
+        self.quantization = self.manifest.get("quantization")
+        self.chunk_events = 1
+        self._arrays = None
+
+    def __getstate__(self):
+        # Don't pickle the mapped arrays, which would copy their data
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    @property
+    def arrays(self):
+        """
+        Dictionary of the memory-mapped arrays of the export.
+        """
+        if self._arrays is None:
+            self._arrays = {
+                name: np.load(os.path.join(self.directory, info["file"]), mmap_mode='r')
+                for name, info in self.manifest["arrays"].items()}
+        return self._arrays
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) or np.ndim(index) == 0:
+            return {key: self.dequantized(key, self.arrays[key][index])
+                    for key in self.keys}
+        return self.get_batch(index)
+
+    def dequantized(self, key, rows):
+        """
+        Returns rows of event_data as float32 if they are quantized.
+        """
+        if key != "event_data" or self.quantization is None:
+            return rows
+        return dequantize_event_data(rows, self.quantization)
+
+    def get_batch(self, indices):
+        """
+        Returns a dictionary with the keys arrays of the events at indices,
+        in the order of indices.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + self.length, indices)
+        unique, inverse = np.unique(indices, return_inverse=True)
+        in_order = len(unique) == len(indices) and np.array_equal(unique, indices)
+        batch = {}
+        for key in self.keys:
+            rows = self.dequantized(key, self.arrays[key][unique])
+            batch[key] = rows if in_order else rows[inverse]
+        return batch
+
+    def indices(self, name):
+        """
+        Returns an index array of splits.npz (see EndcapsH5Dataset.indices).
+        """
+        with np.load(os.path.join(self.directory, "splits.npz")) as splits:
+            return splits[name]
+
+    def normalization(self, pixels="all"):
+        """
+        Returns the normalization of the export (see normalization).
+        """
+        with np.load(os.path.join(self.directory, "statistics.npz")) as statistics:
+            return normalization({name[len("total_"):]: statistics[name]
+                                  for name in statistics.files
+                                  if name.startswith("total_")}, pixels)
+
+    def root_files(self, start=0, stop=None):
+        """
+        Returns the root file path of events [start, stop) as an array of str.
+        """
+        table = np.asarray(self.manifest["root_file_table"], dtype=object)
+        return table[self.arrays["root_file_index"][start:stop]]
@@ -0,0 +1,157 @@
+"""
+Writes synthetic npz files with the schema of the event dumps read by
+CNN_endcaps_npz_to_h5.py, for benchmarks and tests on machines without
+access to the simulation files.
+
+Events are gammas, electrons and muons with energies up to 1000 MeV,
+vertices uniform in the tank (R < 371 cm, |y| < 521 cm) and isotropic
+directions, like the IWCD 4pi samples. The hits of an event are a
+Cherenkov ring around a random mPMT of the endcap plus dark noise, their
+number grows with the energy above threshold and with the fraction of
+the light reaching the endcap. Most muons have a second, later trigger
+with the hits of the decay electron, and a few events have no hits in
+their first trigger.
+
+Usage:
+  python synthetic_npz.py output_dir --files 4 --events 3000
+"""
+import os
+import argparse
+import numpy as np
+
+from CNN_endcaps_npz_to_h5 import PMT_LABELS, GenMapping
+
+PIDS = (22, 11, 13)
+# Total energy below which a muon makes no Cherenkov light, in MeV
+MUON_THRESHOLD = 160.
+# Fraction of muons with a decay electron in a second trigger, its
+# mean delay in ns and energy in MeV
+DECAY_FRACTION = 0.8
+DECAY_TIME = 2200.
+DECAY_ENERGY = 35.
+
+def ring_hits(rng, num_hits, mpmt_positions, ring_width=1.5):
+    """
+    Returns the PMT numbers of num_hits hits on a ring of random radius
+    around a random mPMT, mpmt_positions holding the (row, col) of each mPMT.
+    """
+    center = mpmt_positions[rng.integers(len(mpmt_positions))]
+    radius = rng.uniform(2., 12.)
+    distance = np.hypot(*(mpmt_positions - center).T)
+    weights = np.exp(-0.5*((distance - radius)/ring_width)**2) + 1e-3
+    mpmts = rng.choice(len(mpmt_positions), num_hits, p=weights/weights.sum())
+    return mpmts*19 + rng.integers(0, 19, num_hits)
+
+def trigger_hits(rng, num_hits, num_dark, trigger_time, mpmt_positions):
+    """
+    Returns the PMT numbers, charges and times of the ring and dark noise
+    hits of a trigger at trigger_time.
+    """
+    num_pmts = len(mpmt_positions)*19
+    pmts = np.concatenate((ring_hits(rng, num_hits, mpmt_positions),
+                           rng.integers(0, num_pmts, num_dark)))
+    charge = np.concatenate((0.3 + rng.gamma(2., 0.6, num_hits),
+                             rng.gamma(4., 0.25, num_dark)))
+    time = np.concatenate((trigger_time + rng.normal(1000., 3., num_hits),
+                           trigger_time + rng.uniform(500., 1500., num_dark)))
+    return pmts, charge, time
+
+def generate_events(num_events, seed=0, hits_per_mev=2., dark_hits=5.,
+                    root_file="synthetic_{}.root"):
+    """
+    Returns a dictionary with the arrays of an npz file of num_events
+    synthetic events. hits_per_mev is the mean number of endcap hits per
+    MeV above threshold when all the light reaches the endcap, dark_hits
+    the mean number of dark noise hits per trigger.
+    """
+    rng = np.random.default_rng(seed)
+    mpmt_positions = GenMapping(PMT_LABELS).astype(np.float64)
+
+    pid = rng.choice(PIDS, num_events).astype(np.int32)
+    energy = rng.uniform(0., 1000., num_events).astype(np.float32)
+    radius = 371.*np.sqrt(rng.random(num_events))
+    phi = rng.uniform(-np.pi, np.pi, num_events)
+    position = np.stack((radius*np.cos(phi), rng.uniform(-521., 521., num_events),
+                         radius*np.sin(phi)), axis=1).astype(np.float32)
+    direction = rng.normal(size=(num_events, 3))
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    direction = direction.astype(np.float32)
+    visible = np.where(pid == 13, np.maximum(energy - MUON_THRESHOLD, 0.), energy)
+    # Light reaching the endcap, most of it for tracks pointing at it
+    endcap_fraction = np.clip(np.abs(direction[:,1]) + rng.normal(0., 0.1, num_events),
+                              0., 1.)**2
+
+    arrays = {key: np.empty(num_events, dtype=object) for key in (
+        "digi_hit_pmt", "digi_hit_charge", "digi_hit_time",
+        "digi_hit_trigger", "trigger_time")}
+    for i in range(num_events):
+        trigger_time = [rng.uniform(0., 100.)]
+        num_hits = [rng.poisson(hits_per_mev*visible[i]*endcap_fraction[i])]
+        if pid[i] == 13 and rng.random() < DECAY_FRACTION:
+            trigger_time.append(trigger_time[0] + rng.exponential(DECAY_TIME))
+            num_hits.append(rng.poisson(hits_per_mev*DECAY_ENERGY*rng.random()))
+        hits = [trigger_hits(rng, n, rng.poisson(dark_hits), t, mpmt_positions)
+                for t, n in zip(trigger_time, num_hits)]
+        arrays["digi_hit_pmt"][i] = np.concatenate([h[0] for h in hits]).astype(np.int32)
+        arrays["digi_hit_charge"][i] = np.concatenate([h[1] for h in hits]).astype(np.float32)
+        arrays["digi_hit_time"][i] = np.concatenate([h[2] for h in hits]).astype(np.float32)
+        arrays["digi_hit_trigger"][i] = np.repeat(
+            np.arange(len(hits), dtype=np.int32), [len(h[0]) for h in hits])
+        arrays["trigger_time"][i] = np.array(trigger_time, dtype=np.float32)
+
+    arrays.update({
+        "pid": pid,
+        "position": position,
+        "direction": direction,
+        "energy": energy,
+        "event_id": np.arange(num_events, dtype=np.int32),
+        "root_file": np.full(num_events, root_file.format(seed)),
+    })
+    return arrays
+
+def write_synthetic_file(path, num_events, seed=0, **kwargs):
+    """
+    Writes an npz file of num_events synthetic events (see generate_events).
+    """
+    np.savez(path, **generate_events(num_events, seed, **kwargs))
+
+def write_synthetic_files(directory, num_files, num_events, seed=0, **kwargs):
+    """
+    Writes num_files npz files of num_events synthetic events to directory,
+    each with its own seed, and the list of their paths to file_list.txt
+    for the converter. Returns the paths of the files.
+    """
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    for i in range(num_files):
+        path = os.path.join(directory, "synthetic_{:04d}.npz".format(i))
+        write_synthetic_file(path, num_events, seed + i, **kwargs)
+        files.append(os.path.abspath(path))
+    with open(os.path.join(directory, "file_list.txt"), "w") as f:
+        f.writelines(path+"\n" for path in files)
+    return files
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Writes synthetic npz files for the npz to hdf5 converter")
+    parser.add_argument("output_dir", type=str,
+                        help="Directory of the npz files and their file_list.txt.")
+    parser.add_argument("--files", type=int, default=4,
+                        help="Number of npz files.")
+    parser.add_argument("--events", type=int, default=3000,
+                        help="Events per file.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the first file, the others use the next seeds.")
+    parser.add_argument("--hits-per-mev", type=float, default=2.,
+                        help="Mean endcap hits per MeV above threshold.")
+    parser.add_argument("--dark-hits", type=float, default=5.,
+                        help="Mean dark noise hits per trigger.")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    config = parse_args()
+    files = write_synthetic_files(config.output_dir, config.files, config.events,
+                                  config.seed, hits_per_mev=config.hits_per_mev,
+                                  dark_hits=config.dark_hits)
+    print("Wrote {} files of {} events to {}".format(
+        len(files), config.events, config.output_dir))